@@ -6,15 +6,32 @@ and displays it to the screen via `ChatangoOverlay`.
 '''
 from os import path
 import asyncio
+import fnmatch
+import functools
+import gzip
+import hashlib
+import inspect
+import math
+import multiprocessing
+import os
 import re
+import struct
+import sys
 import json
-from collections import deque
+import time
+import weakref
+import zlib
+from collections import deque, namedtuple
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit
 
 import pytango
 import term_cancer as client
 from term_cancer import linkopen
 __all__ = ["ChatBot", "ChatangoMessage", "ChatangoOverlay"
-	, "get_color", "get_client"]
+	, "get_color", "get_client", "on_event"]
 
 #SETTINGS AND CUSTOM SCRIPTS----------------------------------------------------
 FILENAME = "chatango_creds"
@@ -22,6 +39,9 @@ FILENAME = "chatango_creds"
 HOME_PATH = path.expanduser('~/.cubecli')
 CUSTOM_PATH = path.join(HOME_PATH, "custom")
 SAVE_PATH = path.join(HOME_PATH, FILENAME)
+VISITED_PATH = path.join(HOME_PATH, "visited")
+SNAPSHOT_PATH = path.join(HOME_PATH, "snapshots")
+ROOMS_PATH = path.join(HOME_PATH, "rooms")
 #code ripped from stackoverflow questions/1057431
 CUSTOM_DOC = "ensures the `import custom` in will import all python files "\
 "in the directory"
@@ -42,6 +62,14 @@ def _write_init():
 BEGIN_COLORS = client.colors.defined
 _CLIENT = None
 
+def in_executor(func, *args, **kwargs):
+	'''
+	Run blocking `func` in the event loop's default thread pool executor.
+	Returns an awaitable for the result.
+	'''
+	loop = asyncio.get_event_loop()
+	return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
 class _Persistent:
 	'''
 	A JSON manifest-like abstraction. Acts like a dict for the most part.
@@ -87,14 +115,29 @@ class _Persistent:
 			with open(filename) as i:
 				json_data = json.load(i)
 			for i, bit in self._readwrite.items():
+				value = self._from_json(i, json_data)
 				if bit&1:
-					self._data[i] = json_data.get(i)
-				self._entire[i] = json_data.get(i)
+					self._data[i] = value
+				self._entire[i] = value
 		except (FileNotFoundError, ValueError):
 			pass
 		except Exception as exc:
 			raise IOError("Fatal error reading creds! Aborting...") from exc
 
+	def _from_json(self, field, json_data):
+		'''
+		Get `field` from `json_data`, falling back to the default if it is absent
+		(i.e. written by an older version) and filling in missing dict keys
+		'''
+		default = self._default[field]
+		if field not in json_data:
+			return default.copy() if isinstance(default, (dict, list)) \
+				else default
+		value = json_data[field]
+		if isinstance(default, dict) and isinstance(value, dict):
+			value = dict(default, **value)
+		return value
+
 	def write_json(self, filename):
 		'''Write fields to JSON `filename`'''
 		try:
@@ -110,6 +153,10 @@ class _Persistent:
 		except Exception as exc:
 			raise IOError("Fatal error writing creds!") from exc
 
+	async def read_json_async(self, filename):
+		'''Read fields from JSON `filename` without blocking the event loop'''
+		await in_executor(self.read_json, filename)
+
 	def no_rw(self, field):
 		'''Field will be neither read from file nor written to file'''
 		self._readwrite[field] = 0
@@ -145,6 +192,8 @@ def make_creds():
 	creds.add_field("options", default={
 		  "mouse":		False
 		, "linkwarn":	linkopen.open_link.warning_count
+		, "openlimit":	OPENER.workers
+		, "historyworkers":	HISTORY_PREPARER.workers
 		, "ignoresave":	False
 		, "bell":		True
 		, "256color":	False
@@ -153,6 +202,8 @@ def make_creds():
 	})
 	creds.add_field("ignores", default=[], readwrite=1)
 	creds.add_field("filtered_channels", default=[0, 0, 0, 0])
+	creds.add_field("filters", default=[])
+	creds.add_field("highlights", default=[])
 
 	return creds
 
@@ -177,6 +228,68 @@ def create_colors():
 	client.colors.def_color("magenta", "magenta")	#15:	both channel
 	client.colors.def_color("white", "white")		#16:	blank channel, visible
 
+class _ColorCache:
+	'''
+	Bounded cache of `client.two56` conversions of HTML colors. A room only uses
+	a few hundred distinct name and font colors, so most conversions are hits.
+	The cache must be cleared when 256 color mode is toggled.
+	'''
+	def __init__(self, size=1024):
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self._cache = {}
+
+	def __call__(self, color):
+		try:
+			ret = self._cache[color]
+		except KeyError:
+			pass
+		else:
+			self.hits += 1
+			return ret
+		self.misses += 1
+		if len(self._cache) >= self.size:
+			#evict the oldest conversion
+			del self._cache[next(iter(self._cache))]
+		ret = client.two56(color)
+		self._cache[color] = ret
+		return ret
+
+	def __len__(self):
+		return len(self._cache)
+
+	def clear(self):
+		'''Forget all conversions'''
+		self._cache.clear()
+
+	def prefetch(self, colors):
+		'''Convert all colors in iterable `colors` that are not yet cached'''
+		for color in colors:
+			if color not in self._cache:
+				self(color)
+
+	@property
+	def hit_rate(self):
+		'''Fraction of lookups that were cache hits'''
+		total = self.hits + self.misses
+		return total and self.hits / total
+
+COLOR_CACHE = _ColorCache()
+
+#instrumentation: callables returning a line of text for /debug
+_INSTRUMENTS = []
+def instrument(func):
+	'''Decorator for adding a line to the /debug output'''
+	_INSTRUMENTS.append(func)
+	return func
+
+@instrument
+def _():
+	return "Color cache: {} entries, {} hits, {} misses ({:.1%} hit rate)".format(
+		len(COLOR_CACHE), COLOR_CACHE.hits, COLOR_CACHE.misses
+		, COLOR_CACHE.hit_rate)
+
 #color by user's name
 def get_color(name, init=6, split=109, rot=6):
 	'''Old trivial hash for assigning colors from string `name`'''
@@ -190,6 +303,275 @@ def get_color(name, init=6, split=109, rot=6):
 		total ^= (i > split) and i or ~i
 	return BEGIN_COLORS + (total+rot)%11
 
+#visited links------------------------------------------------------------------
+@functools.lru_cache(maxsize=8192)
+def _link_hash(link):
+	'''Normalize a link (no scheme, "www.", or trailing slash) and hash it'''
+	link = link.strip().split("://", 1)[-1]
+	host, slash, rest = link.partition('/')
+	host = host.lower()
+	if host.startswith("www."):
+		host = host[4:]
+	normal = (host + slash + rest).rstrip('/')
+	return int.from_bytes(hashlib.blake2b(normal.encode()
+		, digest_size=8).digest(), "little")
+
+class VisitedLinks:
+	'''
+	Persistent index of visited links. Links are normalized and hashed to
+	64 bit integers, which are kept in a set and appended to `filename` as
+	8 byte records. The file is read in the executor on the first lookup or
+	visit; until it has been read, only links visited this session are known,
+	and nothing is written, so that links already in the file aren't repeated.
+	Links opened directly with `linkopen.open_link` instead of `open_link`
+	are not recorded.
+	'''
+	_RECORD = struct.Struct("<Q")
+	def __init__(self, filename):
+		self.filename = filename
+		self.loaded = False
+		self._hashes = set()
+		self._unwritten = []
+		self._loading = None
+		self._flushing = None
+		self._redraw = []
+
+	def __len__(self):
+		return len(self._hashes)
+
+	def add_redraw_method(self, func):
+		'''Add a function to call when the index changes, i.e. after reading it'''
+		self._redraw.append(func)
+
+	def redraw(self):
+		'''Call the functions added with add_redraw_method'''
+		for i in self._redraw:
+			i()
+
+	def is_visited(self, link):
+		'''Whether `link` has been visited'''
+		if not self.loaded:
+			self._start_load()
+		return _link_hash(link) in self._hashes
+
+	def visited(self, links):
+		'''Get a list of whether each link in `links` has been visited'''
+		if not self.loaded:
+			self._start_load()
+		hashes = self._hashes
+		return [_link_hash(i) in hashes for i in links]
+
+	def visit(self, links):
+		'''Mark a link or list of links as visited'''
+		if isinstance(links, str):
+			links = (links,)
+		for i in links:
+			link_hash = _link_hash(i)
+			if link_hash not in self._hashes:
+				self._hashes.add(link_hash)
+				self._unwritten.append(link_hash)
+		if not self.loaded:
+			self._start_load()
+		if self._unwritten and self._flushing is None:
+			try:
+				loop = asyncio.get_running_loop()
+			except RuntimeError:
+				return
+			self._flushing = loop.create_task(self._flush_async())
+
+	def read(self):
+		'''Read and return all hashes in the file'''
+		try:
+			with open(self.filename, "rb") as i:
+				data = i.read()
+		except FileNotFoundError:
+			return set()
+		#ignore a partially written last record
+		data = data[:len(data) - len(data) % self._RECORD.size]
+		return {i for i, in self._RECORD.iter_unpack(data)}
+
+	def write(self, hashes):
+		'''Append `hashes` to the file'''
+		with open(self.filename, "ab") as out:
+			out.write(b"".join(map(self._RECORD.pack, hashes)))
+
+	def flush(self):
+		'''
+		Synchronously write links not yet written. Not safe to call from another
+		thread while the event loop might be writing; use flush_async there.
+		'''
+		hashes, self._unwritten = self._unwritten, []
+		if hashes and not self.loaded:
+			stored = self.read()
+			hashes = [i for i in hashes if i not in stored]
+		if hashes:
+			self.write(hashes)
+
+	def _start_load(self):
+		if self._loading is not None:
+			return
+		try:
+			loop = asyncio.get_running_loop()
+		except RuntimeError:
+			return
+		self._loading = loop.create_task(self._load_async())
+
+	async def _load_async(self):
+		try:
+			stored = await in_executor(self.read)
+			#links visited before loading may already be in the file
+			self._unwritten = [i for i in self._unwritten if i not in stored]
+			self._hashes.update(stored)
+		except OSError:
+			pass
+		self.loaded = True
+		self.redraw()
+
+	async def _flush_async(self):
+		try:
+			if self._loading is not None:
+				await asyncio.shield(self._loading)
+			while self._unwritten:
+				hashes, self._unwritten = self._unwritten, []
+				await in_executor(self.write, hashes)
+		except OSError:
+			pass
+		finally:
+			self._flushing = None
+
+	async def flush_async(self):
+		'''
+		Write links not yet written, after any reading or writing under way.
+		The list of links is taken on the event loop, so no link is lost or
+		written twice.
+		'''
+		tasks = [i for i in (self._loading, self._flushing) if i is not None]
+		if tasks:
+			await asyncio.gather(*tasks, return_exceptions=True)
+		hashes, self._unwritten = self._unwritten, []
+		try:
+			if hashes and not self.loaded:
+				stored = await in_executor(self.read)
+				hashes = [i for i in hashes if i not in stored]
+			if hashes:
+				await in_executor(self.write, hashes)
+		except OSError:
+			pass
+
+VISITED = VisitedLinks(VISITED_PATH)
+
+def open_link(parent, links, *args):
+	'''Open a link or list of links through OPENER, recording them in VISITED'''
+	OPENER.open(parent, links, *args)
+
+class LinkOpener:
+	'''
+	Opener that all links go through. Lists of at least linkwarn links
+	(`linkopen.open_link.warning_count`) are confirmed first. Links are then
+	queued and opened one at a time by `workers` tasks, and recorded in VISITED.
+	When linkopen returns an awaitable for a link (i.e. its external process),
+	the worker waits for it, so at most `workers` openers run at once; in any
+	case, a worker waits at least `interval` seconds between links.
+	Progress is shown in the blurb, and the queue can be dropped with `cancel`.
+	'''
+	interval = 0.5
+	def __init__(self, workers=3):
+		self.workers = workers
+		self.parent = None
+		self._queue = deque()
+		self._tasks = []
+		self._opened = 0
+		self._total = 0
+
+	def __len__(self):
+		return len(self._queue)
+
+	def open(self, parent, links, *args):
+		'''Open a link or list of links, confirming if there are many'''
+		if isinstance(links, str):
+			links = [links]
+		if not links:
+			return
+		warning = linkopen.open_link.warning_count
+		if warning and 1 < len(links) and warning <= len(links):
+			parent.loop.create_task(self._confirm(parent, list(links), args))
+			return
+		self._enqueue(parent, links, args)
+
+	async def _confirm(self, parent, links, args):
+		prompt = client.InputOverlay(parent, "Open {} links? (y/n)".format(
+			len(links)))
+		prompt.add()
+		try:
+			answer = await prompt.result
+		except asyncio.CancelledError:
+			return
+		if answer.strip().lower().startswith('y'):
+			self._enqueue(parent, links, args)
+
+	def _enqueue(self, parent, links, args):
+		self.parent = parent
+		self._queue.extend((link, args) for link in links)
+		self._total += len(links)
+		if len(links) > self.workers:
+			parent.blurb.push("Opening {} links; ^x to cancel".format(len(links)))
+
+		self._tasks = [i for i in self._tasks if not i.done()]
+		for _ in range(min(self.workers, len(self._queue)) - len(self._tasks)):
+			self._tasks.append(parent.loop.create_task(self._worker()))
+
+	def cancel(self):
+		'''Drop all links which have not been opened yet'''
+		if not self._queue:
+			return
+		remaining = len(self._queue)
+		self._queue.clear()
+		if self._opened:
+			VISITED.redraw()
+		self._opened = self._total = 0
+		self.parent.blurb.push("Canceled opening {} links".format(remaining))
+
+	async def _worker(self):
+		while self._queue:
+			link, args = self._queue.popleft()
+			start = self.parent.loop.time()
+			opening = linkopen.open_link(self.parent, link, *args)
+			#only count the link as visited once it has actually been opened
+			VISITED.visit(link)
+			self._opened += 1
+			if self._total > self.workers:
+				if self._queue:
+					self.parent.blurb.push("Opening links ({}/{})".format(
+						self._opened, self._total))
+				else:
+					self.parent.blurb.push("Opened {} links".format(self._total))
+			if not self._queue:
+				self._opened = self._total = 0
+				#recoloring is a full redraw, so only once the links are opened
+				VISITED.redraw()
+			if inspect.isawaitable(opening):
+				try:
+					await opening
+				except Exception: #pylint: disable=broad-except
+					pass
+			await asyncio.sleep(max(0
+				, start + self.interval - self.parent.loop.time()))
+
+OPENER = LinkOpener()
+
+@instrument
+def _():
+	chatbot = get_client()
+	if chatbot is None:
+		return "Post index: no client"
+	return "Post index: {} posts, {} duplicates skipped".format(
+		len(chatbot.posts), chatbot.duplicates)
+
+@instrument
+def _():
+	return "Visited links: {} known{}".format(len(VISITED)
+		, "" if VISITED.loaded else " (not yet loaded)")
+
 #ChatBot related functionality--------------------------------------------------
 def get_client():
 	'''Get the current client instance, or if none such exists, None'''
@@ -230,237 +612,1670 @@ class DequeSet(deque):
 		'''Extend left side of deque with each element in iterable'''
 		super().extendleft(filter(lambda x: x not in self, iterable))
 
+class PostQueue:
+	'''
+	Outgoing post queue for a ChatBot. Posts are released through a token bucket
+	whose rate is cut on flood warnings and bans and slowly recovers afterward.
+	Posts are only dropped by `clear` (/clearqueue), and are held while the
+	connection is lost. Once posts have to wait, consecutive posts to the same
+	channel are batched into one post of at most `batch_length` characters.
+	'''
+	batch_length = 800
+	min_rate = 1/30		#never slower than one post every 30 seconds
+	def __init__(self, bot, rate=1.0, burst=4):
+		self.bot = bot
+		self.max_rate = rate	#posts per second
+		self.rate = rate
+		self.burst = burst
+		self._tokens = burst
+		self._last = bot.loop.time()
+		self._banned_until = 0
+		self._posts = deque()
+		self._wakeup = asyncio.Event()
+		self._task = None
+		self.paused = False
+
+	def __len__(self):
+		return len(self._posts)
+
+	def put(self, text, channel):
+		'''Queue `text` to be posted in `channel`'''
+		self._posts.append((text, channel))
+		self._start()
+		self.bot.update_status()
+
+	def wake(self):
+		'''(Re)start sending posts, i.e. after (re)connecting'''
+		self.paused = False
+		self._wakeup.set()
+		self._start()
+
+	def pause(self):
+		'''Hold posts until the next wake, i.e. after the connection is lost'''
+		self.paused = True
+
+	def _start(self):
+		if self._task is None or self._task.done():
+			self._task = self.bot.loop.create_task(self._run())
+
+	def clear(self):
+		'''Drop all queued posts'''
+		self._posts.clear()
+		self.bot.update_status()
+
+	def warn(self):
+		'''Back off after a flood warning'''
+		self.rate = max(self.min_rate, self.rate / 2)
+		self._tokens = 0
+
+	def ban(self, secs):
+		'''Hold all posts for `secs` seconds and back off further'''
+		self._banned_until = self.bot.loop.time() + secs
+		self.rate = max(self.min_rate, self.rate / 4)
+		self._tokens = 0
+
+	def _refill(self):
+		now = self.bot.loop.time()
+		self._tokens = min(self.burst, self._tokens + (now - self._last)*self.rate)
+		self._last = now
+		return now
+
+	def _next_post(self, batch):
+		'''Pop the next post, batching more posts into it if `batch`'''
+		text, channel = self._posts.popleft()
+		while batch and self._posts:
+			next_text, next_channel = self._posts[0]
+			if next_channel != channel \
+			or len(text) + len(next_text) + 1 > self.batch_length:
+				break
+			text += '\n' + next_text
+			self._posts.popleft()
+		return text, channel
+
+	async def _run(self):
+		deferred = False
+		while self._posts:
+			group = self.bot.joined_group
+			if group is None or self.paused:
+				#wait until we're connected again
+				self._wakeup.clear()
+				await self._wakeup.wait()
+				continue
+			now = self._refill()
+			if now < self._banned_until:
+				deferred = True
+				await asyncio.sleep(self._banned_until - now)
+				continue
+			if self._tokens < 1:
+				deferred = True
+				await asyncio.sleep((1 - self._tokens) / self.rate)
+				continue
+			self._tokens -= 1
+			#posts that had to wait get batched with the ones behind them
+			post = self._next_post(deferred)
+			try:
+				group.send_post(*post)
+			except (ConnectionError, OSError):
+				#keep the post for when we've reconnected
+				self._posts.appendleft(post)
+				self.pause()
+				continue
+			deferred = False
+			#additive recovery after each successful send
+			self.rate = min(self.max_rate, self.rate + self.max_rate/20)
+			self.bot.update_status()
+
+def _link_host(link):
+	'''Get the lowercase host name of a link, which may lack a scheme'''
+	if "//" not in link:
+		link = "//" + link
+	try:
+		return urlsplit(link).hostname or ""
+	except ValueError:
+		return ""
+
+class UserKey:
+	'''
+	Canonical form of a user name, computed once and shared by all posts from
+	that user. `name` is the name as displayed; `bare` is the name without the
+	anon ('!') or temp ('#') sigil; `key` is the interned, lowercase bare name
+	used for ignores and the member list; `kind` is "anon", "temp", or "user".
+	Instances should be retrieved with `UserKey.of`, and only live as long as
+	something (i.e. a message) refers to them.
+	'''
+	__slots__ = ("name", "bare", "key", "kind", "_color", "__weakref__")
+	SIGILS = {'!': "anon", '#': "temp"}
+	_registry = weakref.WeakValueDictionary()
+	def __init__(self, name):
+		self.name = name
+		kind = self.SIGILS.get(name[:1])
+		self.bare = name[1:] if kind else name
+		self.kind = kind or "user"
+		self.key = sys.intern(self.bare.lower())
+		self._color = None
+
+	def __str__(self):
+		return self.name
+
+	def __repr__(self):
+		return "UserKey({!r})".format(self.name)
+
+	@classmethod
+	def of(cls, name):
+		'''Get the UserKey for `name`, creating it if it does not exist'''
+		name = str(name)
+		ret = cls._registry.get(name)
+		if ret is None:
+			ret = cls(name)
+			cls._registry[name] = ret
+		return ret
+
+	@property
+	def color(self):
+		'''Color number from the hash of the name'''
+		if self._color is None:
+			self._color = get_color(self.name)
+		return self._color
+
+class FilterRules:
+	'''
+	Ignore and filter rules, compiled into one matcher per channel.
+	Rules are lists of [kind, pattern, channel], where `kind` is one of `KINDS`
+	and `channel` is a channel number, or None for every channel:
+		user:	exact (case-insensitive) username
+		glob:	username glob, like "anon*"
+		regex:	regular expression searched in the post
+		domain:	domain of a link in the post, including subdomains
+		class:	"anon" or "temp" users
+	Exact names and domains are kept in sets; globs and regexes are each joined
+	into a single alternation, except for regexes which can't be joined (those
+	with groups, which may be backreferenced, or global flags), which are kept
+	separately. Invalid regexes are skipped. `generation` is incremented whenever the rules,
+	ignore list, or channel filters change, so that results can be cached.
+	'''
+	KINDS = ("user", "glob", "regex", "domain", "class")
+	def __init__(self, ignores, filtered_channels, rules):
+		self.ignores = ignores						#set reference
+		self.filtered_channels = filtered_channels	#list reference
+		self.rules = rules							#list reference
+		self.generation = 0
+		self._matchers = []
+		self.compile()
+
+	def add(self, kind, pattern, channel=None):
+		'''Add a rule. Raises ValueError if the rule is malformed.'''
+		if kind not in self.KINDS:
+			raise ValueError("Unknown rule kind '{}'".format(kind))
+		if kind == "class" and pattern not in UserKey.SIGILS.values():
+			raise ValueError("User class must be one of {}".format(
+				", ".join(UserKey.SIGILS.values())))
+		if kind == "regex":
+			try:
+				re.compile(pattern)
+			except re.error as exc:
+				raise ValueError("Invalid regex: {}".format(exc)) from exc
+		rule = [kind, pattern, channel]
+		if rule not in self.rules:
+			self.rules.append(rule)
+			self.compile()
+
+	def remove(self, kind, pattern, channel=None):
+		'''Remove a rule. Returns whether the rule existed.'''
+		try:
+			self.rules.remove([kind, pattern, channel])
+		except ValueError:
+			return False
+		self.compile()
+		return True
+
+	def invalidate(self):
+		'''Mark cached results stale, i.e. after changing ignores or channels'''
+		self.generation += 1
+
+	def compile(self):
+		'''Rebuild the per-channel matchers from the rule list'''
+		self._matchers = [self._compile_channel(i) \
+			for i in range(len(self.filtered_channels))]
+		self.invalidate()
+
+	def _compile_channel(self, channel):
+		users, domains, classes = set(), set(), set()
+		globs, regexes = [], []
+		for kind, pattern, rule_channel in self.rules:
+			if rule_channel is not None and rule_channel != channel:
+				continue
+			if kind == "user":
+				users.add(UserKey.of(pattern).key)
+			elif kind == "glob":
+				globs.append(fnmatch.translate(pattern.lower()))
+			elif kind == "regex":
+				try:
+					regexes.append(re.compile(pattern))
+				except re.error:
+					pass
+			elif kind == "domain":
+				domains.add(pattern.lower().strip('.'))
+			elif kind == "class":
+				classes.add(pattern)
+
+		join = lambda patterns: re.compile('|'.join(
+			"(?:{})".format(i) for i in patterns)) if patterns else None
+		joinable = [i.pattern for i in regexes if self._joinable(i)]
+		regexes = [i for i in regexes if not self._joinable(i)]
+		if joinable:
+			regexes.insert(0, join(joinable))
+		return users, join(globs), regexes, domains, classes
+
+	@staticmethod
+	def _joinable(regex):
+		'''Whether compiled `regex` means the same inside an alternation'''
+		if regex.groups:
+			return False
+		try:
+			re.compile("(?:{})".format(regex.pattern))
+		except re.error:
+			return False
+		return True
+
+	def matches(self, user, channel, text):
+		'''Whether a post by UserKey `user` in `channel` should be filtered'''
+		if self.filtered_channels[channel]:
+			return True
+		if user.key in self.ignores:
+			return True
+
+		users, globs, regexes, domains, classes = self._matchers[channel]
+		if user.key in users or user.kind in classes:
+			return True
+		if globs is not None and globs.match(user.key):
+			return True
+		if any(regex.search(text) for regex in regexes):
+			return True
+		if domains:
+			for link in linkopen.LINK_RE.findall(text):
+				host = _link_host(link)
+				#check the domain and every parent domain
+				while host:
+					if host in domains:
+						return True
+					host = host.partition('.')[2]
+		return False
+
+class KeywordMatcher:
+	'''
+	Aho-Corasick automaton for finding any of a list of keywords in a post in a
+	single pass, regardless of how many keywords there are. Matching is
+	case-insensitive, and keywords only match as whole words. The automaton is
+	rebuilt when keywords are added or removed, which increments `generation`.
+	'''
+	def __init__(self, keywords):
+		self.keywords = keywords	#list reference
+		self.generation = -1
+		self._goto = [{}]
+		self._fail = [0]
+		self._output = [()]
+		self.build()
+
+	def __len__(self):
+		return len(self.keywords)
+
+	def add(self, *keywords):
+		'''Add keywords and rebuild'''
+		for i in keywords:
+			i = i.lower()
+			if i and i not in self.keywords:
+				self.keywords.append(i)
+		self.build()
+
+	def remove(self, *keywords):
+		'''Remove keywords and rebuild'''
+		for i in keywords:
+			try:
+				self.keywords.remove(i.lower())
+			except ValueError:
+				pass
+		self.build()
+
+	def build(self):
+		'''Build the trie and failure links from the keyword list'''
+		goto, output = [{}], [()]
+		for word in self.keywords:
+			state = 0
+			for char in word:
+				next_state = goto[state].get(char)
+				if next_state is None:
+					next_state = len(goto)
+					goto[state][char] = next_state
+					goto.append({})
+					output.append(())
+				state = next_state
+			output[state] += (len(word),)
+
+		#breadth-first, so that failure links always point to finished states
+		fail = [0] * len(goto)
+		queue = deque(goto[0].values())
+		while queue:
+			state = queue.popleft()
+			for char, next_state in goto[state].items():
+				queue.append(next_state)
+				fallback = fail[state]
+				while fallback and char not in goto[fallback]:
+					fallback = fail[fallback]
+				fail[next_state] = goto[fallback].get(char, 0)
+				output[next_state] += output[fail[next_state]]
+
+		self._goto, self._fail, self._output = goto, fail, output
+		self.generation += 1
+
+	def search(self, text):
+		'''Return the first keyword found in `text`, or None'''
+		if not self.keywords:
+			return None
+		goto, fail, output = self._goto, self._fail, self._output
+		text = text.lower()
+		last = len(text) - 1
+		state = 0
+		for i, char in enumerate(text):
+			while state and char not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(char, 0)
+			for length in output[state]:
+				start = i - length + 1
+				#whole words only
+				if (start == 0 or not text[start-1].isalnum()) \
+				and (i == last or not text[i+1].isalnum()):
+					return text[start:i+1]
+		return None
+
+def cook_post(raw):
+	'''Clean up the text of a post for display'''
+	#remove egregiously large amounts of newlines (more than 2)
+	#also edit sections with right to left override
+	cooked = ""
+	newline_count = 0
+	rtlbuffer, rtl = "", False
+	for i in raw:
+		if i == '\n':
+			#right-to-left sequences end on newlines
+			if rtl:
+				cooked += rtlbuffer + (newline_count < 2 and i or "")
+				rtl = False
+				rtlbuffer = ""
+			if newline_count < 2:
+				cooked += i
+			newline_count += 1
+		#technically not right, since RTL marks should match marks, and
+		#overrides overrides
+		elif ord(i) in (8206, 8237):
+			cooked += rtlbuffer
+			rtlbuffer = ""
+			rtl = False
+		elif ord(i) in (8207, 8238):
+			rtl = True
+		else:
+			newline_count = 0
+			if rtl:
+				rtlbuffer = i + rtlbuffer
+			else:
+				cooked += i
+	if rtl:
+		cooked += rtlbuffer
+	return cooked
+
+def unique_links(raw):
+	'''Get the links in `raw`, without duplicates, in order of appearance'''
+	links = []
+	#don't add the same link twice
+	for i in linkopen.LINK_RE.findall(raw+' '):
+		if i not in links:
+			links.append(i)
+	return links
+
 class ChatangoMessage(client.Message):
 	'''Message subclass for chatango posts'''
 	_LINE_RE = re.compile(r"^( [!#]?\w+?: (@\w* )*)?(.+)$", re.MULTILINE)
 	_QUOTE_RE = re.compile(r"@\w+?: `[^`]+`")
 
 	#self.overlay.msg_append(ChatangoMessage(post, self, self.me, False
-	def __init__(self, post, bot, me, ishistory, alts=None): #pylint: disable=too-many-arguments
-		isreply = (me is not None and me in post.mentions) or \
-			(alts is not None and any(i in post.mentions for i in alts if i))
-
-		#remove egregiously large amounts of newlines (more than 2)
-		#also edit sections with right to left override
-		cooked = ""
-		newline_count = 0
-		rtlbuffer, rtl = "", False
-		for i in post.post:
-			if i == '\n':
-				#right-to-left sequences end on newlines
-				if rtl:
-					cooked += rtlbuffer + (newline_count < 2 and i or "")
-					rtl = False
-					rtlbuffer = ""
-				if newline_count < 2:
-					cooked += i
-				newline_count += 1
-			#technically not right, since RTL marks should match marks, and
-			#overrides overrides
-			elif ord(i) in (8206, 8237):
-				cooked += rtlbuffer
-				rtlbuffer = ""
-				rtl = False
-			elif ord(i) in (8207, 8238):
-				rtl = True
-			else:
-				newline_count = 0
-				if rtl:
-					rtlbuffer = i + rtlbuffer
-				else:
-					cooked += i
-		if rtl:
-			cooked += rtlbuffer
+	def __init__(self, post, bot, me, ishistory, alts=None, prepared=None): #pylint: disable=too-many-arguments
+		#filter result, valid while bot.filters.generation is unchanged
+		self._filter_generation = -1
+		self._filter_result = False
+		#spans from tokenize, computed on first colorize
+		self._tokens = None
+		mentions = post.mentions
+		isreply = bool(mentions) and ((me is not None and me in mentions) or \
+			(alts is not None and any(i in mentions for i in alts if i)))
+		#highlights are rechecked when the keywords change
+		self._mentioned = isreply
+		self._highlight_generation = bot.highlights.generation
+
+		if prepared is None:
+			isreply = isreply or bot.highlights.search(post.post) is not None
+			cooked = cook_post(post.post)
+		else:
+			isreply = isreply or prepared.highlighted
+			cooked = prepared.cooked
+			self._tokens = prepared.tokens
+			self._filter_generation = prepared.filter_generation
+			self._filter_result = prepared.filtered
 
+		user = UserKey.of(post.user)
 		#format as ' user: message'; the space is for the channel
-		super().__init__(" {}: {}".format(str(post.user), cooked)
+		super().__init__(" {}: {}".format(user.name, cooked)
 		#extra arguments to use in colorizers
-			, bot=bot, post=post, reply=isreply, history=ishistory)
+			, bot=bot, post=post, user=user, reply=isreply, history=ishistory)
 
 		if bot.options["bell"] and isreply and not ishistory and \
 		not self.filtered:
 			bot.overlay.parent.sound_bell()
 
-	def colorize(self):
-		raw_white = client.colors.raw_num(0)
-		#these names are important
-		name_color = client.two56(self.post.n_color)
-		font_color = client.two56(self.post.f_color)
-		visited_link = client.grayscale(12)
+	@classmethod
+	def tokenize(cls, text):
+		'''
+		Split formatted message `text` into the spans that colorize needs:
+		a list of (start, is_greentext) for each line's content, a list of
+		(start, end, link) for each link, and a list of (start, end) for each
+		quote. Since the text of a message never changes, this is done once.
+		'''
+		if '\n' in text:
+			lines = [(i.start(3), i.group(3)[0] == '>') \
+				for i in cls._LINE_RE.finditer(text)]
+		else:
+			match = cls._LINE_RE.match(text)
+			lines = [(match.start(3), match.group(3)[0] == '>')] if match else []
+		links = [(i.start(1), i.end(1), i.group(1)) \
+			for i in linkopen.LINK_RE.finditer(text)]
+		#a quote needs a backtick, which most posts don't have
+		quotes = [i.span() for i in cls._QUOTE_RE.finditer(text)] \
+			if '`' in text else []
+		return lines, links, quotes
 
+	def colorize(self):
 		#use name colors?
-		username = str(self.post.user)
-		if not self.bot.options["htmlcolor"] \
-		or (self.bot.options["anoncolor"] and username[0] in "!#"):
-			name_color = get_color(username)
-			font_color = get_color(username)
+		user = self.user
+		post = self.post
+		options = self.bot.options
+		if not options["htmlcolor"] \
+		or (options["anoncolor"] and user.kind != "user"):
+			name_color = font_color = user.color
+		else:
+			name_color = COLOR_CACHE(post.n_color)
+			font_color = COLOR_CACHE(post.f_color)
+
+		tokens = self._tokens
+		if tokens is None:
+			tokens = self._tokens = self.tokenize(str(self))
+		lines, links, quotes = tokens
+		if self._highlight_generation != self.bot.highlights.generation:
+			self.update_reply()
 
+		#color runs by position; later assignments take precedence
+		#insurance the @s before a > are colored right
+		#		space/username/:(space)
+		runs = {1+len(user.name)+2: font_color}
 		#greentext, font color
-		text_color = lambda x: x[0] == '>' and BEGIN_COLORS+11 or font_color
-		self.color_by_regex(self._LINE_RE, text_color, group=3)
+		for start, greentext in lines:
+			runs[start] = BEGIN_COLORS+11 if greentext else font_color
+		#links in white, visited links in gray
+		if links:
+			raw_white = client.colors.raw_num(0)
+			visited_link = client.grayscale(12)
+			is_visited = VISITED.is_visited
+			for start, end, link in links:
+				runs[start] = visited_link if is_visited(link) else raw_white
+				runs[end] = font_color
+		#make sure we color the name right
+		runs[1] = name_color
+		#channel
+		runs[0] = BEGIN_COLORS + post.channel + 12
 
-		#links in white
-		link_color = lambda x: visited_link \
-			if linkopen.open_link.is_visited(x) else raw_white
-		self.color_by_regex(linkopen.LINK_RE, link_color, font_color, 1)
+		insert_color = self.insert_color
+		for position, color in sorted(runs.items()):
+			insert_color(position, color)
 
 		#underline quotes
-		self.effect_by_regex(self._QUOTE_RE, 1)
-
-		#make sure we color the name right
-		self.insert_color(1, name_color)
-		#insurance the @s before a > are colored right
-		#		space/username/:(space)
-		msg_start = 1+len(username)+2
-		if not self.colored_at(msg_start):
-			self.insert_color(msg_start, font_color)
+		for start, end in quotes:
+			self.effect_range(start, end, 1)
 		if self.reply:
 			self.add_global_effect(0, 1)
 		if self.history:
 			self.add_global_effect(1, 1)
 
-		#channel
-		self.insert_color(0, BEGIN_COLORS + self.post.channel + 12)
+	def update_reply(self):
+		'''Recheck highlight keywords if they've changed. Returns `reply`.'''
+		highlights = self.bot.highlights
+		if self._highlight_generation != highlights.generation:
+			self._highlight_generation = highlights.generation
+			self.reply = self._mentioned \
+				or highlights.search(self.post.post) is not None
+		return self.reply
 
 	def filter(self):
-		username = str(self.post.user)
-		if username[0] in "!#":
-			username = username[1:]
-		return any((
-			#filtered channels
-			  self.bot.filtered_channels[self.post.channel]
-			#ignored users
-			, username.lower() in self.bot.ignores
-		))
+		rules = self.bot.filters
+		if self._filter_generation != rules.generation:
+			self._filter_result = rules.matches(self.user, self.post.channel
+				, self.post.post)
+			self._filter_generation = rules.generation
+		return self._filter_result
+
+#history preparation-----------------------------------------------------------
+PreparedPost = namedtuple("PreparedPost", ("cooked", "tokens", "links"
+	, "highlighted", "filter_generation", "filtered"))
+
+def prepare_posts(posts, filters, highlights):
+	'''
+	Do the work of constructing ChatangoMessages that does not need the UI.
+	`posts` is a list of (user name, channel, text) tuples. Returns a list of
+	picklable PreparedPost, so that this can run in another process.
+	'''
+	ret = []
+	for name, channel, text in posts:
+		user = UserKey.of(name)
+		cooked = cook_post(text)
+		ret.append(PreparedPost(cooked
+			, ChatangoMessage.tokenize(" {}: {}".format(user.name, cooked))
+			, unique_links(text)
+			, highlights.search(text) is not None
+			, filters.generation
+			, filters.matches(user, channel, text)))
+	return ret
+
+class HistoryPreparer:
+	'''
+	Prepares large history batches on a process pool. Batches of at least
+	`threshold` posts are split among `workers` processes; smaller batches,
+	or any batch when `workers` is 0, are not worth the pickling overhead.
+	Workers are started fresh (not forked from the UI process, which has a
+	terminal and running threads), and if the pool fails, batches are
+	prepared in-process instead.
+	'''
+	threshold = 200
+	_start_method = "forkserver" \
+		if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+	def __init__(self, workers=0):
+		self._workers = workers
+		self._pool = None
+
+	@property
+	def workers(self):
+		'''Number of processes in the pool; 0 to disable'''
+		return self._workers
+
+	@workers.setter
+	def workers(self, value):
+		if value != self._workers:
+			self.shutdown()
+		self._workers = value
+
+	def shutdown(self):
+		'''Stop the process pool, if one has been started'''
+		if self._pool is not None:
+			self._pool.shutdown(wait=False)
+			self._pool = None
+
+	async def prepare(self, history, filters, highlights):
+		'''
+		Get a list of PreparedPost for `history`, or None if not worth it or
+		the pool failed, in which case the posts should be prepared in-process
+		'''
+		if not self._workers or len(history) < self.threshold:
+			return None
+		posts = [(str(i.user), i.channel, i.post) for i in history]
+		size = -(-len(posts) // self._workers)
+		loop = asyncio.get_event_loop()
+		try:
+			if self._pool is None:
+				self._pool = ProcessPoolExecutor(self._workers
+					, mp_context=multiprocessing.get_context(self._start_method))
+			chunks = await asyncio.gather(*(loop.run_in_executor(self._pool
+				, prepare_posts, posts[i:i+size], filters, highlights) \
+				for i in range(0, len(posts), size)))
+		except (BrokenProcessPool, OSError, RuntimeError):
+			#the pool is unusable; start a new one next time
+			self.shutdown()
+			return None
+		return [post for chunk in chunks for post in chunk]
+
+HISTORY_PREPARER = HistoryPreparer()
+
+class PrivateMessage(client.Message):
+	'''Message subclass for private messages'''
+	def __init__(self, post, ishistory):
+		user = UserKey.of(post.user)
+		super().__init__(" {}: {}".format(user.name, post.post)
+			, post=post, user=user, history=ishistory)
+
+	def colorize(self):
+		self.insert_color(1, self.user.color)
+		self.insert_color(2 + len(self.user.name), client.colors.raw_num(0))
+		if self.history:
+			self.add_global_effect(1, 1)
+
+class GapMessage(client.Message):
+	'''Marker between detached posts and the room history below them'''
+	def __init__(self):
+		super().__init__("Messages may be missing here; scroll up for more "\
+			"history")
+
+	def colorize(self):
+		self.insert_color(0, client.grayscale(12))
+
+class PMConversation:
+	'''
+	Private conversation with one user. Only raw posts are kept; they are
+	made into messages when the conversation is shown, and then only the last
+	`page_size` of them, until more are requested.
+	'''
+	max_posts = 1000
+	page_size = 100
+	def __init__(self, user):
+		self.user = user	#UserKey
+		self.posts = deque(maxlen=self.max_posts)
+		self.historical = 0	#number of posts from before connecting
+		self.unread = 0
+		#posts are numbered in the order added, since old ones are dropped
+		self.added = 0
+		self.first_shown = 0	#number of the oldest post made into a message
+
+	def add(self, post, historical, unread):
+		'''Add a new post to the conversation'''
+		self.posts.append(post)
+		self.added += 1
+		if historical:
+			self.historical += 1
+		if unread:
+			self.unread += 1
+
+	def show_latest(self):
+		'''Start paging from the newest post, i.e. when the conversation is shown'''
+		self.first_shown = self.added
+
+	def page(self):
+		'''Get the next page of posts not yet shown, oldest first'''
+		first = self.added - len(self.posts)	#number of posts[0]
+		end = max(first, self.first_shown)
+		start = max(first, end - self.page_size)
+		self.first_shown = start
+		return [self.posts[i - first] for i in range(start, end)]
+
+def post_key(post):
+	'''Key identifying a post, for recognizing posts that were already seen'''
+	return (post.time, str(post.user), post.post)
+
+#EVENT HOOKS--------------------------------------------------------------------
+class Hook:
+	'''
+	A subscriber to an EventBus event. Events are queued per hook and handled
+	in order by the hook's own task, so a slow hook only delays itself.
+	`func` may be a coroutine function or a plain function; if `offloop`,
+	plain functions run in the EventBus's executor instead of on the event
+	loop. Calls longer than `budget` seconds are reported as slow, and
+	coroutines and off-loop calls are abandoned after `timeout` seconds.
+	An abandoned off-loop call can't be stopped, so until it finishes, the
+	hook's later events are dropped rather than taking more threads.
+	'''
+	backlog = 1000	#queued events before the oldest are dropped
+	def __init__(self, func, budget, timeout, offloop): #pylint: disable=too-many-arguments
+		self.func = func
+		self.name = getattr(func, "__qualname__", repr(func))
+		self.budget = budget
+		self.timeout = timeout
+		self.offloop = offloop
+		self.calls = 0
+		self.slow = 0
+		self.errors = 0
+		self.dropped = 0
+		self.total_time = 0
+		self.worst_time = 0
+		self._queue = deque()
+		self._task = None
+		self._running = None	#future of the last off-loop call
+
+	def __str__(self):
+		return "{}: {} calls, {:.1f} ms avg, {:.1f} ms worst, {} slow, "\
+			"{} errors, {} dropped".format(self.name, self.calls
+			, 1000*self.total_time / max(1, self.calls), 1000*self.worst_time
+			, self.slow, self.errors, self.dropped)
+
+	def push(self, bus, args):
+		'''Queue a call with `args`, starting the hook's task if needed'''
+		if len(self._queue) >= self.backlog:
+			self._queue.popleft()
+			self.dropped += 1
+		self._queue.append(args)
+		if self._task is None or self._task.done():
+			self._task = asyncio.get_event_loop().create_task(self._run(bus))
+
+	async def _call(self, bus, args):
+		if asyncio.iscoroutinefunction(self.func):
+			await asyncio.wait_for(self.func(*args), self.timeout)
+		elif self.offloop:
+			loop = asyncio.get_event_loop()
+			self._running = loop.run_in_executor(bus.executor
+				, functools.partial(self.func, *args))
+			await asyncio.wait_for(asyncio.shield(self._running), self.timeout)
+		else:
+			self.func(*args)
+
+	async def _run(self, bus):
+		while self._queue:
+			args = self._queue.popleft()
+			if self._running is not None and not self._running.done():
+				self.dropped += 1
+				continue
+			start = time.perf_counter()
+			error = None
+			try:
+				await self._call(bus, args)
+			except asyncio.TimeoutError:
+				error = "timed out after {}s".format(self.timeout)
+			except Exception as exc: #pylint: disable=broad-except
+				error = "raised {}".format(type(exc).__name__)
+			elapsed = time.perf_counter() - start
+			self.calls += 1
+			self.total_time += elapsed
+			self.worst_time = max(self.worst_time, elapsed)
+			if error is not None:
+				self.errors += 1
+				if self._should_report(self.errors):
+					bus.report("Hook {} {} ({} times)".format(self.name, error
+						, self.errors))
+			elif elapsed > self.budget:
+				self.slow += 1
+				if self._should_report(self.slow):
+					bus.report("Hook {} is slow ({:.0f} ms, budget {:.0f} ms)"\
+						.format(self.name, 1000*elapsed, 1000*self.budget))
+
+	@staticmethod
+	def _should_report(count):
+		#don't spam for hooks that always misbehave
+		return count in (1, 10, 100) or not count % 1000
+
+class EventBus:
+	'''
+	Events that ChatBot publishes for custom modules, and their subscribers.
+	Publishing only queues the event for each hook, so it costs the message
+	handler nothing when there are no subscribers, and little otherwise.
+		message:	(post)
+		history:	(list of posts)
+		join:		(user)
+		leave:		(user)
+		connect:	(group)
+		error:		(error)
+	'''
+	EVENTS = ("message", "history", "join", "leave", "connect", "error")
+	def __init__(self, workers=4):
+		self.hooks = {i: [] for i in self.EVENTS}
+		self.reporter = None
+		#off-loop hooks get their own threads, so that hung ones can't hold up
+		#the default executor
+		self.executor = ThreadPoolExecutor(workers
+			, thread_name_prefix="chatango-hook")
+
+	def subscribe(self, event, func, budget=0.01, timeout=5, offloop=False): #pylint: disable=too-many-arguments
+		'''Add `func` as a subscriber to `event`. Returns the Hook.'''
+		if event not in self.hooks:
+			raise ValueError("Unknown event '{}'".format(event))
+		hook = Hook(func, budget, timeout, offloop)
+		self.hooks[event].append(hook)
+		return hook
+
+	def unsubscribe(self, event, hook):
+		'''Remove a Hook returned by subscribe'''
+		self.hooks[event].remove(hook)
+
+	def publish(self, event, *args):
+		'''Queue `event` with arguments `args` for all of its subscribers'''
+		for hook in self.hooks[event]:
+			hook.push(self, args)
+
+	def report(self, text):
+		'''Report a problem with a hook'''
+		if self.reporter is not None:
+			self.reporter(text)
+
+EVENT_BUS = EventBus()
+
+def on_event(event, budget=0.01, timeout=5, offloop=False):
+	'''
+	Decorator for subscribing a function to a ChatBot event. See EventBus
+	for event names and their arguments, and Hook for the keyword arguments.
+	'''
+	def wrap(func):
+		EVENT_BUS.subscribe(event, func, budget, timeout, offloop)
+		return func
+	return wrap
+
+@instrument
+def _():
+	hooks = [str(hook) for event in EVENT_BUS.hooks.values() for hook in event]
+	return "Hooks: " + ("; ".join(hooks) if hooks else "none")
+
+#ACTIVITY STATISTICS------------------------------------------------------------
+class TopCounter:
+	'''
+	Approximate counts of the `size` most frequent keys in a stream, in
+	constant memory (the Space-Saving algorithm). A new key evicts the key
+	with the smallest count and inherits that count as its error bound.
+	'''
+	def __init__(self, size=64):
+		self.size = size
+		self._counts = {}	#key: [count, error]
+
+	def add(self, key, amount=1):
+		'''Count `amount` more occurrences of `key`'''
+		entry = self._counts.get(key)
+		if entry is not None:
+			entry[0] += amount
+			return
+		if len(self._counts) < self.size:
+			self._counts[key] = [amount, 0]
+			return
+		smallest = min(self._counts, key=lambda i: self._counts[i][0])
+		least = self._counts.pop(smallest)[0]
+		self._counts[key] = [least + amount, least]
+
+	def most_common(self, count=None):
+		'''List of (key, count) of the most frequent keys'''
+		ret = sorted(((key, entry[0]) for key, entry in self._counts.items())
+			, key=lambda i: i[1], reverse=True)
+		return ret[:count]
+
+class DistinctCounter:
+	'''
+	Approximate number of distinct keys in a stream (HyperLogLog), using
+	2**`precision` one byte registers. The standard error is about
+	1.04/sqrt(2**precision): 3% for the default.
+	'''
+	def __init__(self, precision=10):
+		self.precision = precision
+		self._registers = bytearray(1 << precision)
+
+	def add(self, key):
+		'''Add a key, which must be a str'''
+		value = int.from_bytes(hashlib.blake2b(key.encode()
+			, digest_size=8).digest(), "little")
+		index = value & ((1 << self.precision) - 1)
+		rest = value >> self.precision
+		rank = 65 - self.precision - rest.bit_length()
+		if rank > self._registers[index]:
+			self._registers[index] = rank
+
+	def __len__(self):
+		registers = len(self._registers)
+		alpha = 0.7213 / (1 + 1.079/registers)
+		estimate = alpha * registers**2 / sum(2.0**-i for i in self._registers)
+		zeros = self._registers.count(0)
+		#small range correction
+		if estimate <= 2.5*registers and zeros:
+			estimate = registers * math.log(registers / zeros)
+		return int(round(estimate))
+
+class MinuteWindow:
+	'''Ring buffer of per-minute counts for the last `minutes` minutes'''
+	def __init__(self, minutes=60):
+		self._counts = [0] * minutes
+		self._minutes = [-1] * minutes
+
+	def add(self, when):
+		'''Count an event at UNIX time `when`'''
+		minute = int(when // 60)
+		index = minute % len(self._counts)
+		if self._minutes[index] != minute:
+			#older than anything the buffer can hold
+			if minute < self._minutes[index]:
+				return
+			self._minutes[index] = minute
+			self._counts[index] = 0
+		self._counts[index] += 1
+
+	def rate(self, minutes, now=None):
+		'''Average events per minute over the last `minutes` minutes'''
+		current = int((time.time() if now is None else now) // 60)
+		total = sum(count for minute, count in zip(self._minutes, self._counts) \
+			if current - minutes < minute <= current)
+		return total / minutes
+
+class RoomStats:
+	'''Streaming, constant memory activity statistics for a room'''
+	WINDOWS = (1, 5, 15, 60)
+	def __init__(self):
+		self.posts = 0
+		self.links = 0
+		self.channels = [0] * len(pytango.CHANNEL_NAMES)
+		self.by_user = TopCounter()
+		self.links_by_user = TopCounter()
+		self.users = DistinctCounter()
+		self.per_minute = MinuteWindow(max(self.WINDOWS))
+
+	def add(self, post, user, links):
+		'''Count a post by UserKey `user` containing `links` links'''
+		self.posts += 1
+		self.channels[post.channel] += 1
+		self.by_user.add(user.key)
+		self.users.add(user.key)
+		self.per_minute.add(post.time)
+		if links:
+			self.links += links
+			self.links_by_user.add(user.key, links)
+
+	def lines(self, count=10):
+		'''Describe the statistics as a list of lines'''
+		ret = ["{} posts by about {} users, {} links".format(self.posts
+			, len(self.users), self.links)]
+		ret.append("Posts per minute: " + ", ".join("{:.1f} ({}m)".format(
+			self.per_minute.rate(i), i) for i in self.WINDOWS))
+		ret.append("Channels: " + ", ".join("{} {}".format(name, number) \
+			for name, number in zip(pytango.CHANNEL_NAMES, self.channels)))
+		ret.append("Most posts:")
+		ret.extend("  {}: {}".format(*i) for i in self.by_user.most_common(count))
+		ret.append("Most links:")
+		ret.extend("  {}: {}".format(*i) \
+			for i in self.links_by_user.most_common(count))
+		return ret
+
+#SESSION SNAPSHOTS--------------------------------------------------------------
+SNAPSHOT_VERSION = 2
+SNAPSHOT_POSTS = 500	#number of posts to keep
+SNAPSHOT_LINKS = 1000	#number of links to keep
+
+class SnapshotPost:
+	'''Stand-in for a pytango Post restored from a snapshot or transcript'''
+	__slots__ = ("user", "post", "time", "channel", "n_color", "f_color"
+		, "mentions")
+	def __init__(self, user, post, time, channel, n_color, f_color, mentions): #pylint: disable=too-many-arguments
+		self.user = user
+		self.post = post
+		self.time = time
+		self.channel = channel
+		self.n_color = n_color
+		self.f_color = f_color
+		self.mentions = mentions
+
+	@classmethod
+	def to_tuple(cls, post):
+		'''Convert a post into a tuple of plain data'''
+		return (str(post.user), post.post, post.time, post.channel
+			, post.n_color, post.f_color, list(post.mentions))
+
+def _room_filename(room):
+	return re.sub(r"[^\w-]", "_", room)
+
+def _snapshot_file(room):
+	return path.join(SNAPSHOT_PATH, _room_filename(room))
+
+def read_snapshot(room):
+	'''
+	Read the snapshot of `room`, as a tuple of lists of posts, links,
+	and member names. Returns None if there is no usable snapshot.
+	'''
+	try:
+		with open(_snapshot_file(room), "rb") as i:
+			data = json.loads(zlib.decompress(i.read()))
+		if data[0] != SNAPSHOT_VERSION:
+			return None
+		_, posts, links, members = data
+		return [SnapshotPost(*i) for i in posts], list(links), list(members)
+	except (OSError, ValueError, TypeError, KeyError, IndexError, zlib.error):
+		return None
+
+def write_snapshot(room, posts, links, members):
+	'''Write the snapshot of `room` as compressed JSON'''
+	os.makedirs(SNAPSHOT_PATH, exist_ok=True)
+	data = [SNAPSHOT_VERSION, [SnapshotPost.to_tuple(i) for i in posts]
+		, list(links), list(members)]
+	with open(_snapshot_file(room), "wb") as out:
+		out.write(zlib.compress(json.dumps(data, separators=(',', ':'))\
+			.encode("utf-8")))
+
+#TRANSCRIPTS--------------------------------------------------------------------
+#transcripts are JSON lines of posts (*.jsonl) or a JSON object of columns of
+#post fields (*.json), either of which may be gzipped (*.gz)
+TRANSCRIPT_FIELDS = ("user", "post", "time", "channel", "n_color", "f_color"
+	, "mentions")
+TRANSCRIPT_EXTENSIONS = (".jsonl", ".jsonl.gz", ".json", ".json.gz")
+TRANSCRIPT_CHUNK = 200	#posts shown between yields to the event loop
+
+def _open_transcript(filename, mode):
+	if filename.endswith(".gz"):
+		return gzip.open(filename, mode + 't', encoding="utf-8")
+	return open(filename, mode, encoding="utf-8")
+
+def _is_columnar(filename):
+	return filename.endswith((".json", ".json.gz"))
+
+def write_transcript(filename, posts):
+	'''Write `posts` to the transcript `filename`. Returns the number written.'''
+	count = 0
+	with _open_transcript(filename, 'w') as out:
+		if _is_columnar(filename):
+			columns = {field: [] for field in TRANSCRIPT_FIELDS}
+			for post in posts:
+				for field, value in zip(TRANSCRIPT_FIELDS
+				, SnapshotPost.to_tuple(post)):
+					columns[field].append(value)
+				count += 1
+			json.dump(columns, out, separators=(',', ':'))
+			return count
+		#one line at a time, so the whole transcript isn't built in memory
+		for post in posts:
+			out.write(json.dumps(dict(zip(TRANSCRIPT_FIELDS
+				, SnapshotPost.to_tuple(post))), separators=(',', ':')))
+			out.write('\n')
+			count += 1
+	return count
+
+def _check_post(post):
+	'''Raise TypeError if the fields of `post` aren't those of a real post'''
+	if not all(isinstance(i, str) for i in (post.user, post.post, post.n_color
+	, post.f_color)) \
+	or not isinstance(post.time, (int, float)) or isinstance(post.time, bool) \
+	or not isinstance(post.channel, int) or isinstance(post.channel, bool) \
+	or not 0 <= post.channel < len(pytango.CHANNEL_NAMES) \
+	or not isinstance(post.mentions, list) \
+	or not all(isinstance(i, str) for i in post.mentions):
+		raise TypeError("Bad post fields")
+
+def read_transcript(filename):
+	'''
+	Read the transcript `filename` as a list of posts.
+	Raises ValueError if it is not a transcript.
+	'''
+	try:
+		with _open_transcript(filename, 'r') as i:
+			if _is_columnar(filename):
+				columns = json.load(i)
+				posts = [SnapshotPost(*post) for post in \
+					zip(*(columns[field] for field in TRANSCRIPT_FIELDS))]
+			else:
+				posts = [SnapshotPost(*(record[field] \
+					for field in TRANSCRIPT_FIELDS)) \
+					for record in map(json.loads, filter(str.strip, i))]
+		for post in posts:
+			_check_post(post)
+		return posts
+	except (KeyError, TypeError, EOFError) as exc:
+		raise ValueError("Malformed transcript") from exc
+
+#ROOM SETTINGS------------------------------------------------------------------
+def make_room_settings(creds):
+	'''
+	Create the per-room settings as _Persistent and return. Rooms without a
+	settings file start from the global values in `creds`.
+	'''
+	settings = _Persistent()
+	#ignores are read-only unless saved, like in creds
+	settings.add_field("ignores", default=creds["ignores"], readwrite=1)
+	settings.add_field("filtered_channels", default=creds["filtered_channels"])
+	settings.add_field("formatting", default=creds["formatting"])
+	settings.add_field("last_read", default=None)
+	return settings
+
+class RoomSettings:
+	'''
+	Store of per-room settings, as a JSON file per room in `directory`.
+	Settings are read the first time a room is joined and the `size` most
+	recently used rooms are kept in memory, so switching between them is free.
+	'''
+	def __init__(self, directory, size=8):
+		self.directory = directory
+		self.size = size
+		self._cache = {}	#room: _Persistent, least recently used first
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self._cache)
+
+	def _filename(self, room):
+		return path.join(self.directory, _room_filename(room) + ".json")
+
+	async def get(self, room, creds):
+		'''Get the settings of `room`, reading them if they aren't cached'''
+		try:
+			settings = self._cache.pop(room)
+			self.hits += 1
+		except KeyError:
+			self.misses += 1
+			settings = make_room_settings(creds)
+			await settings.read_json_async(self._filename(room))
+			#another join might have read them in the meantime
+			settings = self._cache.pop(room, settings)
+		self._cache[room] = settings
+		while len(self._cache) > self.size:
+			del self._cache[next(iter(self._cache))]
+		return settings
+
+	def write(self, room, settings):
+		'''Write the settings of `room`. Blocks, so use an executor.'''
+		os.makedirs(self.directory, exist_ok=True)
+		settings.write_json(self._filename(room))
+
+ROOM_SETTINGS = RoomSettings(ROOMS_PATH)
+
+@instrument
+def _():
+	return "Room settings: {} cached, {} hits, {} misses".format(
+		len(ROOM_SETTINGS), ROOM_SETTINGS.hits, ROOM_SETTINGS.misses)
 
 class ChatBot(pytango.Manager): #pylint: disable=too-many-instance-attributes, too-many-public-methods
 	'''Bot for interacting with the chat'''
 	members = DequeSet()
-	def __init__(self, parent, creds):
+	max_posts = 5000	#newest posts kept in the index of shown posts
+	def __init__(self, parent, creds, snapshot=None):
 		super().__init__(creds["user"], creds["passwd"], loop=parent.loop)
 
 		self.creds = creds
 		#default to the given user name
 		self.alts = []
-		#list references
-		self.ignores = set(creds["ignores"])
-		self.filtered_channels = creds["filtered_channels"]
+		#the global values are defaults for rooms without settings; these
+		#references are shared and updated in place by apply_room_settings
+		self.ignores = set(UserKey.of(i).key for i in creds["ignores"])
+		self.filtered_channels = list(creds["filtered_channels"])
+		self.formatting = list(creds["formatting"])
+		self.room_settings = None
+		self.last_read = None
+		self.filters = FilterRules(self.ignores, self.filtered_channels
+			, creds["filters"])
+		self.highlights = KeywordMatcher(creds["highlights"])
 		self.options = creds["options"]
 		self._prepend_history = False
 
 		self.connecting = False
 		self.joined_group = None
 		self.channel = 0
+		#newest posts shown in the overlay, by post_key
+		self.posts = {}
+		self.trimmed = 0	#posts shown but dropped from the index
+		#time of the oldest post shown; older history goes above it
+		self.oldest = None
+		#posts shown above the room's history that it hasn't reached back to
+		#(imported, or kept from before a gap), newest first
+		self.detached = []
+		self.duplicates = 0
+		self.stats = RoomStats()
 
 		self.overlay = ChatangoOverlay(parent, self)
 		self.overlay.add()
+		self.post_queue = PostQueue(self)
+		#private conversations, most recent last
+		self.conversations = {}
+		self.pm_view = None
 
 		#disconnect from all groups on done
 		client.on_done(self.graceful_exit())
+		EVENT_BUS.reporter = self.overlay.parent.blurb.push
 
 		#tabbing for members, ignoring the # and ! induced by anons and temps
 		self.overlay.completer.add_sigil('@', self.members)
-		self.loop.create_task(self.connect())
+		if snapshot is not None:
+			self.restore(*snapshot)
+		#restored posts are reconciled with history like after a reconnect
+		self.loop.create_task(self.connect(snapshot is not None))
 
 	@property
 	def me(self):
 		if self.joined_group is not None:
-			uname = self.joined_group.username
-			if uname[0] in "#!":
-				uname = uname[1:]
-			return uname
+			return UserKey.of(self.joined_group.username).bare
 		return None
 
-	async def connect(self):
+	async def connect(self, keep_history=False):
 		if self.connecting:
 			return
 		self.connecting = True
-		self.members.clear()
+		if not keep_history:
+			self.members.clear()
 		self.overlay.msg_system("Connecting")
-		await self.join_group(self.creds["room"])
+		await self.join_group(self.creds["room"], keep_history)
 		self.connecting = False
 
 	async def reconnect(self):
 		await self.leave_group(self.joined_group)
-		await self.connect()
+		#keep what we have; history will only fill in what we missed
+		await self.connect(True)
 
-	async def join_group(self, group_name): #pylint: disable=arguments-differ
+	async def join_group(self, group_name, keep_history=False): #pylint: disable=arguments-differ
 		await self.leave_group(self.joined_group)
-		self.overlay.messages.delete(lambda x: isinstance(x, ChatangoMessage), True)
+		new_room = group_name != self.creds["room"]
+		if new_room and self.room_settings is not None:
+			self.save_room_settings()
+		if not keep_history or new_room:
+			self.overlay.messages.delete(lambda x: isinstance(x, ChatangoMessage)
+				, True)
+			self.posts.clear()
+			self.trimmed = 0
+			self.oldest = None
+			self.detached = []
+			self.stats = RoomStats()
 		self._prepend_history = False
 		self.creds["room"] = group_name
+		if new_room or self.room_settings is None:
+			self.apply_room_settings(await ROOM_SETTINGS.get(group_name
+				, self.creds))
 		try:
 			await super().join_group(group_name)
 		except (ConnectionError, ValueError):
 			self.overlay.msg_system("Failed to connect to room '{}'".format(
 				self.creds["room"]))
 
+	def restore(self, posts, links, members):
+		'''Show posts, links, and members from a session snapshot'''
+		me = UserKey.of(self.creds["user"]).bare if self.creds["user"] else None
+		for post in posts:
+			self.posts[post_key(post)] = post
+			message = ChatangoMessage(post, self, me, True, alts=self.alts)
+			self.stats.add(post, message.user, len(unique_links(post.post)))
+			self.overlay.msg_append(message)
+		self.overlay.add_links(links)
+		self.members.extend(members)
+		if posts:
+			self.oldest = posts[0].time
+			self.overlay.msg_system("Restored {} messages from last session"\
+				.format(len(posts)))
+
+	def snapshot(self):
+		'''Get the posts, links, and members to save in a session snapshot'''
+		posts = sorted(self.posts.values(), key=lambda post: post.time)
+		return (posts[-SNAPSHOT_POSTS:], self.overlay.last_links[-SNAPSHOT_LINKS:]
+			, list(self.members)[:SNAPSHOT_POSTS])
+
+	async def export_transcript(self, filename, room=None):
+		'''
+		Write the shown posts, or those in the snapshot of `room`, to the
+		transcript `filename` from the executor. Only the newest `max_posts`
+		shown posts are kept, so the blurb says if older ones were left out.
+		'''
+		blurb = self.overlay.parent.blurb
+		if room is None:
+			posts = sorted(self.posts.values(), key=lambda post: post.time)
+		else:
+			snapshot = await in_executor(read_snapshot, room)
+			if snapshot is None:
+				blurb.push("No snapshot of room '{}'".format(room))
+				return
+			posts = snapshot[0]
+		blurb.push("Exporting {} messages".format(len(posts)))
+		try:
+			count = await in_executor(write_transcript, filename, posts)
+		except OSError as exc:
+			blurb.push("Failed to export: {}".format(exc.strerror or exc))
+			return
+		trimmed = self.trimmed if room is None else 0
+		blurb.push("Exported {} messages to {}{}".format(count, filename
+			, "; {} older messages were no longer kept".format(trimmed) \
+			if trimmed else ""))
+
+	async def import_transcript(self, filename):
+		'''
+		Read the transcript `filename` from the executor and show its posts older
+		than those shown above them, yielding to the event loop every
+		TRANSCRIPT_CHUNK posts. Imported posts are kept out of the index of
+		shown posts (so out of snapshots and exports), and are detached, i.e.
+		replaced by the room's history when scrolling back reaches them.
+		'''
+		blurb = self.overlay.parent.blurb
+		try:
+			posts = await in_executor(read_transcript, filename)
+		except OSError as exc:
+			blurb.push("Failed to import: {}".format(exc.strerror or exc))
+			return
+		except ValueError as exc:
+			blurb.push("Failed to import: {}".format(exc))
+			return
+		#newest first, like history; the rest overlap what is already shown
+		count = len(posts)
+		oldest = self.detached[-1].time if self.detached else self.oldest
+		if oldest is not None:
+			posts = [post for post in posts if post.time < oldest]
+		posts.sort(key=lambda post: post.time, reverse=True)
+
+		group = self.joined_group
+		me = UserKey.of(self.creds["user"]).bare if self.creds["user"] else None
+		links = []
+		if posts and not self.detached and self.oldest is not None:
+			self.overlay.msg_prepend(GapMessage())
+		for i, post in enumerate(posts):
+			if i and not i % TRANSCRIPT_CHUNK:
+				await asyncio.sleep(0)
+				#the messages were cleared by joining another room
+				if group is not self.joined_group:
+					return
+			#history may have reached back past the rest in the meantime
+			if self.detached and post.time >= self.detached[-1].time:
+				continue
+			message = ChatangoMessage(post, self, me, True, alts=self.alts)
+			links.extend(unique_links(post.post))
+			self.overlay.msg_prepend(message)
+			self.detached.append(post)
+		self.overlay.add_links(links, True)
+		blurb.push("Imported {} messages from {}{}".format(len(posts), filename
+			, "; {} were not older than those shown".format(count - len(posts)) \
+			if count > len(posts) else ""))
+
+	def apply_room_settings(self, settings):
+		'''Use the ignores, channel filters, and formatting in room `settings`'''
+		self.room_settings = settings
+		self.ignores.clear()
+		self.ignores.update(UserKey.of(i).key for i in settings["ignores"])
+		self.filtered_channels[:] = settings["filtered_channels"]
+		self.formatting[:] = settings["formatting"]
+		self.last_read = settings["last_read"]
+		self.filters.invalidate()
+		self.overlay.redo_lines()
+
+	def store_room_settings(self):
+		'''
+		Put the state of the current room into its settings and return them.
+		The global values in creds follow along, as the defaults for new rooms.
+		'''
+		settings = self.room_settings
+		#ignores is a set and not a list reference, so we update the list now
+		for persistent in (settings, self.creds):
+			persistent["ignores"] = list(self.ignores)
+			persistent["filtered_channels"] = list(self.filtered_channels)
+			persistent["formatting"] = list(self.formatting)
+		if self.posts:
+			settings["last_read"] = max(post.time for post in self.posts.values())
+		if self.options["ignoresave"]:
+			settings.set_write("ignores")
+		else:
+			settings.clear_write("ignores")
+		return settings
+
+	def save_room_settings(self):
+		'''
+		Store the state of the current room in its settings and write them from
+		the executor. Returns a task that finishes when they are written.
+		'''
+		room, settings = self.creds["room"], self.store_room_settings()
+		async def write():
+			try:
+				await in_executor(ROOM_SETTINGS.write, room, settings)
+			except OSError:
+				pass
+		return self.loop.create_task(write())
+
 	async def graceful_exit(self):
-		#this is a set and not a list reference, so we update the list now
-		self.creds["ignores"] = list(self.ignores)
+		if self.room_settings is not None:
+			await self.save_room_settings()
+		if self.creds["room"] and self.posts:
+			try:
+				await in_executor(write_snapshot, self.creds["room"]
+					, *self.snapshot())
+			except OSError:
+				pass
+		await VISITED.flush_async()
+		HISTORY_PREPARER.shutdown()
 		await self.leave_all()
+		EVENT_BUS.executor.shutdown(wait=False)
 
 	def set_formatting(self):
 		group = self.joined_group
 
-		group.f_color = self.creds["formatting"][0]
-		group.n_color = self.creds["formatting"][1]
-		group.f_face = self.creds["formatting"][2]
-		group.f_size = self.creds["formatting"][3]
+		group.f_color = self.formatting[0]
+		group.n_color = self.formatting[1]
+		group.f_face = self.formatting[2]
+		group.f_size = self.formatting[3]
 
-	def send_post(self, text):
-		if self.joined_group is None:
-			return
-		self.joined_group.send_post(text, self.channel)
+	def send_post(self, text, channel=None):
+		'''
+		Queue a post to the current group. Posts are rate limited by `post_queue`
+		rather than sent immediately, so scripts may call this as often as they
+		like without being flood banned.
+		'''
+		if channel is None:
+			channel = self.channel
+		self.post_queue.put(text, channel)
+
+	def update_status(self):
+		'''Show user count and queued post count in the status bar'''
+		status = ""
+		if self.joined_group is not None:
+			status = str(self.joined_group.usercount)
+		if self.post_queue:
+			status = "{} queued | {}".format(len(self.post_queue), status)
+		unread = self.unread_pms
+		if unread:
+			status = "PM:{} | {}".format(unread, status)
+		self.overlay.right = status
 
 	def send_pm(self, user, text):
+		'''Send a private message. Returns whether it was sent.'''
+		blurb = self.overlay.parent.blurb
 		if self.privates is None:
+			blurb.push("Not connected to PMs; message not sent")
+			return False
+		try:
+			self.pm.send_post(user, text)
+		except (ConnectionError, OSError):
+			blurb.push("Failed to send PM to {}".format(user))
+			return False
+		#self.me is only known in a room
+		dummy = pytango.Post.private(self.privates, (self.creds["user"], 0, 0, 0
+			, 0, text))
+		#our own posts are filed under the recipient
+		self._add_pm(UserKey.of(user), dummy, False, False)
+		return True
+
+	def conversation(self, user):
+		'''Get the PMConversation with UserKey `user`, creating it if needed'''
+		try:
+			conversation = self.conversations.pop(user.key)
+		except KeyError:
+			conversation = PMConversation(user)
+		#reinsert, so that the dict is ordered by recency
+		self.conversations[user.key] = conversation
+		return conversation
+
+	def _add_pm(self, user, post, historical, unread):
+		conversation = self.conversation(user)
+		view = self.pm_view
+		if view is not None and view.conversation is conversation:
+			unread = False
+			view.msg_append(PrivateMessage(post, historical))
+		conversation.add(post, historical, unread)
+		if unread:
+			self.update_status()
+
+	@property
+	def unread_pms(self):
+		'''Total number of unread private messages'''
+		return sum(i.unread for i in self.conversations.values())
+
+	async def connect_pm(self):
+		'''Connect to PMs if not already connected'''
+		if self.privates is not None:
 			return
-		self.pm.send_post(user, text)
-		dummy = pytango.Post.private(self.privates, (self.me, 0, 0, 0, 0, text))
-		self.loop.create_task(self.on_pm(None, dummy, False))
+		self.overlay.msg_system("Connecting to PMs")
+		try:
+			await self.join_pm()
+		except (ConnectionError, ValueError):
+			self.overlay.msg_system("Failed to connect to PMs")
+
+	async def upload_avatar_async(self, location):
+		'''
+		Upload the file at `location` as the user's avatar from the executor,
+		reporting progress in the blurb until the upload finishes
+		'''
+		blurb = self.overlay.parent.blurb
+		try:
+			size = await in_executor(path.getsize, location)
+		except OSError:
+			blurb.push("Failed to update avatar: could not read file")
+			return False
+
+		upload = in_executor(self.upload_avatar, location)
+		elapsed = 0
+		while True:
+			blurb.push("Uploading avatar ({:.1f} KiB, {}s)".format(
+				size/1024, elapsed))
+			try:
+				success = await asyncio.wait_for(asyncio.shield(upload), 1)
+				break
+			except asyncio.TimeoutError:
+				elapsed += 1
+			except Exception: #pylint: disable=broad-except
+				success = False
+				break
+
+		if success:
+			blurb.push("Successfully updated avatar")
+		else:
+			blurb.push("Failed to update avatar")
+		return success
 
 	async def on_connect(self, group):
 		self.joined_group = group
 		self.set_formatting()
 		self.overlay.left = "{}@{}".format(group.username, group.name)
+		self.post_queue.wake()
 		#show last message time
 		self.overlay.msg_system("Connected to "+group.name)
+		EVENT_BUS.publish("connect", group)
 
 	async def on_pm_connect(self, _):
 		self.overlay.msg_system("Connected to PMs")
 
-	'''
 	async def on_pm(self, _, post, historical):
-		msg = " {}: {}".format(str(post.user), post.post)
-		self.overlay.msg_append(msg, post, True, historical)
-	'''
+		#only file the post; messages are made when the conversation is shown
+		unread = not historical
+		self._add_pm(UserKey.of(post.user), post, historical, unread)
+		if unread and self.options["bell"]:
+			self.overlay.parent.sound_bell()
+
+	def _index_post(self, post, newest=None):
+		'''
+		Add a post to the index of shown posts. Returns False, without adding,
+		if it is already shown or not newer than time `newest`.
+		'''
+		key = post_key(post)
+		if key in self.posts or (newest is not None and post.time <= newest):
+			self.duplicates += 1
+			return False
+		self.posts[key] = post
+		#trim in batches, since it means sorting
+		if len(self.posts) > self.max_posts + self.max_posts // 10:
+			posts = sorted(self.posts.items(), key=lambda item: item[1].time)
+			self.trimmed += len(posts) - self.max_posts
+			self.posts = dict(posts[-self.max_posts:])
+		return True
+
+	def _detach_kept_posts(self):
+		'''
+		Detach the posts kept from before reconnecting (or restored), which
+		history doesn't reach back to, so that history goes below them
+		'''
+		kept = sorted(self.posts.values(), key=lambda post: post.time
+			, reverse=True)
+		#messages already dropped from the index can't be moved with the rest
+		oldest, detached = kept[-1].time, {id(post) for post in self.detached}
+		self.overlay.messages.delete(lambda x: isinstance(x, ChatangoMessage) \
+			and x.post.time < oldest and id(x.post) not in detached, True)
+		self.trimmed = 0
+		self.detached = kept + self.detached
+		self.oldest = None
 
 	async def on_message(self, _, post):
-		#double check for anons
-		username = str(post.user).lower()
-		if username[0] in '!#':
-			username = username[1:]
-		self.members.appendleft(username)
-		self.overlay.parse_links(post.post)
-		self.overlay.msg_append(ChatangoMessage(post, self, self.me, False
-			, alts=self.alts))
+		if not self._index_post(post):
+			return
+		if self.oldest is None:
+			self.oldest = post.time
+		message = ChatangoMessage(post, self, self.me, False, alts=self.alts)
+		self.members.appendleft(message.user.key)
+		links = unique_links(post.post)
+		self.stats.add(post, message.user, len(links))
+		self.overlay.add_links(links)
+		self.overlay.msg_append(message)
+		EVENT_BUS.publish("message", post)
 
 	async def on_history_done(self, group, history):
+		#skip what is already shown; after reconnecting, only take newer posts
+		newest = None
+		if not self._prepend_history and self.posts:
+			newest = max(post.time for post in self.posts.values())
+			#history doesn't reach back to the posts kept from before, so there
+			#is a gap below them, and older history has to go between
+			if history and history[-1].time > newest and not group.no_more:
+				self._detach_kept_posts()
+				newest = None
+		elif self._prepend_history and self.oldest is not None:
+			#kept posts may be newer than where history has got to
+			history = [post for post in history if post.time <= self.oldest]
+		#history replaces the detached posts it reaches back to
+		replaced = set()
+		if history and self.detached:
+			for post in self.detached:
+				key = post_key(post)
+				if post.time >= history[-1].time and self.posts.pop(key, None):
+					replaced.add(key)
+		history = [post for post in history if self._index_post(post, newest)]
+		if not history:
+			self.overlay.can_select = True
+			self._prepend_history = True
+			return
+
+		COLOR_CACHE.prefetch({color for post in history \
+			for color in (post.n_color, post.f_color)})
 		add = self.overlay.msg_prepend
 		if self._prepend_history:
 			self.overlay.msg_time(history[0].time, prepend=True)
 		else:
-			history = reversed(history)
+			history = history[::-1]
 			add = self.overlay.msg_append
 
-		for post in history:
-			username = str(post.user).lower()
-			if username[0] in '!#':
-				username = username[1:]
-			self.members.append(username)
-			self.overlay.parse_links(post.post, self._prepend_history)
-			add(ChatangoMessage(post, self, self.me, True, alts=self.alts))
+		#older history doesn't race with new messages, so it can wait on workers
+		prepared = None
+		if self._prepend_history:
+			prepared = await HISTORY_PREPARER.prepare(history, self.filters
+				, self.highlights)
+			if group is not self.joined_group:
+				#not shown, so the next history shouldn't skip these
+				for post in history:
+					self.posts.pop(post_key(post), None)
+				return
+		if prepared is None:
+			prepared = [None] * len(history)
+		oldest = min(history[0].time, history[-1].time)
+		if self.oldest is None or oldest < self.oldest:
+			self.oldest = oldest
+		#history goes below detached posts
+		detached = []
+		if self.detached:
+			shown = {id(post) for post in self.detached}
+			self.overlay.messages.delete(lambda x: isinstance(x, GapMessage) \
+				or (isinstance(x, ChatangoMessage) and id(x.post) in shown), True)
+			detached = [post for post in self.detached if post.time < self.oldest]
+			self.detached = detached
+
+		#mark where the posts since the room was last left begin
+		unread, last_read = None, self.last_read
+		if not self._prepend_history and last_read is not None:
+			unread = next((i for i, post in enumerate(history) \
+				if post.time > last_read), None)
+			if unread == 0 and newest is None:
+				unread = None
+			self.last_read = None
+
+		me = self.me
+		links = []
+		for i, (post, ready) in enumerate(zip(history, prepared)):
+			if i == unread:
+				self.overlay.msg_time(last_read, "Last read at ")
+			message = ChatangoMessage(post, self, me, True, alts=self.alts
+				, prepared=ready)
+			self.members.append(message.user.key)
+			post_links = unique_links(post.post) if ready is None else ready.links
+			if not replaced or post_key(post) not in replaced:
+				self.stats.add(post, message.user, len(post_links))
+			links.extend(post_links)
+			add(message)
+		if detached:
+			self.overlay.msg_prepend(GapMessage())
+		for post in detached:
+			self.overlay.msg_prepend(ChatangoMessage(post, self, me, True
+				, alts=self.alts))
+		self.overlay.add_links(links, self._prepend_history)
 
 		if not self._prepend_history:
 			self.overlay.msg_time(group.last_message, "Last message at ")
@@ -468,35 +2283,43 @@ class ChatBot(pytango.Manager): #pylint: disable=too-many-instance-attributes, t
 
 		self.overlay.can_select = True
 		self._prepend_history = True
+		EVENT_BUS.publish("history", history)
 
 	async def on_flood_warning(self, _):
+		self.post_queue.warn()
 		self.overlay.msg_system("Flood ban warning issued")
 
 	async def on_flood_ban(self, group, secs):
 		await self.on_flood_ban_repeat(group, secs)
 
 	async def on_flood_ban_repeat(self, _, secs):
+		self.post_queue.ban(secs)
 		self.overlay.msg_system("You are banned for {} seconds".format(secs))
 
 	async def on_participants(self, group):
 		'''On received joined members.'''
-		self.members.extend(map(lambda x: x.name.lower(), group.users))
+		self.members.extend(map(lambda x: UserKey.of(x.name).key, group.users))
 		self.overlay.redo_lines()
 
-	async def on_usercount(self, group):
+	async def on_usercount(self, _):
 		'''On user count changed.'''
-		self.overlay.right = str(group.usercount)
+		self.update_status()
 
 	async def on_member_join(self, _, user):
 		if user != "anon":
-			self.members.appendleft(str(user).lower())
+			self.members.appendleft(UserKey.of(user).key)
 		#notifications
 		self.overlay.parent.blurb.push("{} has joined".format(str(user)))
+		EVENT_BUS.publish("join", user)
 
 	async def on_member_leave(self, _, user):
 		self.overlay.parent.blurb.push("{} has left".format(str(user)))
+		EVENT_BUS.publish("leave", user)
 
 	async def on_connection_error(self, _, error):
+		EVENT_BUS.publish("error", error)
+		#don't send queued posts into a dead connection
+		self.post_queue.pause()
 		if isinstance(error, (ConnectionResetError, type(None))):
 			self.overlay.messages.stop_select()
 			self.overlay.msg_system("Connection lost; press ^r to reconnect")
@@ -509,15 +2332,46 @@ class ChatBot(pytango.Manager): #pylint: disable=too-many-instance-attributes, t
 			"Try again with ^p".format(self.username))
 
 #List Overlay Extensions-------------------------------------------------------
+IMAGE_EXTENSIONS = ("png", "jpg", "jpeg")
+
+def is_image(link):
+	'''Whether `link` looks like it points to an image'''
+	return linkopen.get_extension(link).lower() in IMAGE_EXTENSIONS
+
+@functools.lru_cache(maxsize=1024)
+def _strip_protocol(link):
+	return link.replace("https://", "").replace("http://", "")
+
+class ReversedView(Sequence):
+	'''Read-only view of a list in reverse order, without copying it'''
+	def __init__(self, raw):
+		self.raw = raw
+
+	def __len__(self):
+		return len(self.raw)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self.raw)))]
+		if index < 0:
+			index += len(self.raw)
+		if not 0 <= index < len(self.raw):
+			raise IndexError("ReversedView index out of range")
+		return self.raw[-1 - index]
+
 class LinkOverlay(client.VisualListOverlay):
-	'''ListOverlay of links that renders whether they have been visited'''
-	def __init__(self, parent, last_links):
-		builder = lambda raw: list(reversed(raw))
+	'''
+	ListOverlay of links that renders whether they have been visited.
+	Links are shown newest first through a ReversedView of `last_links`, and
+	`image_links` are the links in `last_links` which are images.
+	'''
+	def __init__(self, parent, last_links, image_links):
+		self.image_links = image_links
 		super().__init__(parent, last_links
-			, modes=["default"] + linkopen.get_defaults(), builder=builder)
+			, modes=["default"] + linkopen.get_defaults(), builder=ReversedView)
 
-		find_new = lambda i: linkopen.open_link.is_visited(self[i]) ^\
-						linkopen.open_link.is_visited(self.current)
+		find_new = lambda i: VISITED.is_visited(self[i]) ^\
+						VISITED.is_visited(self.current)
 		prev_new, next_new = self.goto_lambda(find_new)
 
 		self.add_keys({
@@ -528,21 +2382,22 @@ class LinkOverlay(client.VisualListOverlay):
 
 	def _callback(self, result): #pylint: disable=method-hidden
 		'''Open link with selected opener'''
-		linkopen.open_link(self.parent, result, self.mode)
+		open_link(self.parent, result, self.mode)
 		self.clear()
 
 	def open_images(self):
 		'''Open all images that have not been visited'''
-		linkopen.open_link(self.parent, [link for link in self.list \
-			if (linkopen.get_extension(link).lower() in ("png", "jpg", "jpeg")) \
-			and (not linkopen.open_link.is_visited(link))], self.mode)
+		images = self.image_links[::-1]
+		OPENER.open(self.parent, [link for link, visited \
+			in zip(images, VISITED.visited(images)) if not visited], self.mode)
 
 	def _draw_line(self, line, number):
 		'''Draw visited links in a slightly grayer color'''
+		link = self[number]
 		#remove the protocol
-		line.setstr(str(line).replace("https://", "").replace("http://", ""))
+		line.setstr(_strip_protocol(link))
 		#draw whether this link is visited
-		if linkopen.open_link.is_visited(self[number]):
+		if VISITED.is_visited(link):
 			line.insert_color(0, client.grayscale(12))
 		super()._draw_line(line, number)
 
@@ -551,20 +2406,20 @@ Formatting = client.InputMux()	#pylint: disable=invalid-name
 @Formatting.listel("color")
 def fontcolor(context):
 	"Font Color"
-	return context.bot.creds["formatting"][0]
+	return context.bot.formatting[0]
 @fontcolor.setter
 def _(context, value):
-	context.bot.creds["formatting"][0] = \
+	context.bot.formatting[0] = \
 		client.ColorSliderOverlay.to_hex(value)
 	context.bot.set_formatting()
 
 @Formatting.listel("color")
 def namecolor(context):
 	"Name Color"
-	return context.bot.creds["formatting"][1]
+	return context.bot.formatting[1]
 @namecolor.setter
 def _(context, value):
-	context.bot.creds["formatting"][1] = \
+	context.bot.formatting[1] = \
 		client.ColorSliderOverlay.to_hex(value)
 	context.bot.set_formatting()
 
@@ -572,22 +2427,22 @@ def _(context, value):
 def fontface(context):
 	"Font Face"
 	tab = pytango.FONT_FACES
-	index = context.bot.creds["formatting"][2]
+	index = context.bot.formatting[2]
 	return tab, int(index)
 @fontface.setter
 def _(context, value):
-	context.bot.creds["formatting"][2] = str(value)
+	context.bot.formatting[2] = str(value)
 	context.bot.set_formatting()
 
 @Formatting.listel("enum")
 def fontsize(context):
 	"Font Size"
 	tab = pytango.FONT_SIZES
-	index = context.bot.creds["formatting"][3]
+	index = context.bot.formatting[3]
 	return list(map(str, tab)), tab.index(index)
 @fontsize.setter
 def _(context, value):
-	context.bot.creds["formatting"][3] = pytango.FONT_SIZES[value]
+	context.bot.formatting[3] = pytango.FONT_SIZES[value]
 	context.bot.set_formatting()
 
 #Options InputMux---------------------------------------------------------------
@@ -614,6 +2469,32 @@ def _(context, value):
 	except ValueError:
 		pass
 
+@Options.listel("str")
+def openlimit(context):
+	"Links opened at once when opening many:"
+	return context.bot.options["openlimit"]
+@openlimit.setter
+def _(context, value):
+	try:
+		value = max(1, int(value))
+	except ValueError:
+		return
+	context.bot.options["openlimit"] = value
+	OPENER.workers = value
+
+@Options.listel("str")
+def historyworkers(context):
+	"Processes for loading history (0 for none):"
+	return context.bot.options["historyworkers"]
+@historyworkers.setter
+def _(context, value):
+	try:
+		value = max(0, int(value))
+	except ValueError:
+		return
+	context.bot.options["historyworkers"] = value
+	HISTORY_PREPARER.workers = value
+
 @Options.listel("bool")
 def ignoresave(context):
 	"Save ignore list:"
@@ -644,6 +2525,7 @@ def two56(context):
 def _(context, value):
 	context.bot.options["256color"] = value
 	client.colors.two56on = value
+	COLOR_CACHE.clear()
 	context.redo_lines()
 
 @Options.listel("bool")
@@ -684,14 +2566,12 @@ def _(mux, value, coloring):
 def open_selected_links(message, overlay):
 	'''Open links in selected message'''
 	all_links = linkopen.LINK_RE.findall(str(message))
-	linkopen.open_link(overlay.parent, all_links)
+	OPENER.open(overlay.parent, all_links)
 
 @ChatangoMessage.key_handler("tab")
 def	reply_to_message(message, overlay):
 	'''Reply to selected message'''
-	msg, name = message.post.post, message.post.user
-	if name[0] in "!#":
-		name = name[1:]
+	msg, name = message.post.post, message.user.bare
 	if message.bot.me:
 		msg = msg.replace("@"+message.bot.me, "")
 	overlay.text.append("@{}: `{}`".format(name, msg.replace('`', "")))
@@ -699,17 +2579,12 @@ def	reply_to_message(message, overlay):
 @ChatangoMessage.key_handler("^n")
 def add_ignore(message, overlay):
 	'''Add ignore from selected message'''
-	try:
-		#allmessages contain the colored message and arguments
-		name = message.post.user
-		if name[0] in "!#":
-			name = name[1:]
-		if name in message.bot.ignores:
-			return
-		message.bot.ignores.add(name)
-		overlay.redo_lines()
-	except IndexError:
-		pass
+	name = message.user.key
+	if name in message.bot.ignores:
+		return
+	message.bot.ignores.add(name)
+	message.bot.filters.invalidate()
+	overlay.redo_lines()
 
 @client.Message.key_handler("mouse-left")
 def _click_link(message, overlay, pos):
@@ -726,13 +2601,14 @@ def _click_link(message, overlay, pos):
 			smallest = distance
 			link = i.group()
 	if link:
-		linkopen.open_link(overlay.parent, link)
+		open_link(overlay.parent, link)
 		overlay.redo_lines()
 	return 1
 
 class ChatangoOverlay(client.ChatOverlay):
 	def __init__(self, parent, bot):
 		self.last_links = []
+		self.image_links = []
 
 		super().__init__(parent)
 		self.can_select = False
@@ -743,22 +2619,26 @@ class ChatangoOverlay(client.ChatOverlay):
 			, "f4":		self._show_formatting
 			, "f5":		self._show_channels
 			, "f6":		self._replies_scroller
-#			, "f7":		self.pmConnect
+			, "f7":		self._show_conversations
 			, "f12":	self._show_options
 			, "^f":		self._search_scroller
 			, "^t":		self.join_group
 			, "^p":		self.userpass
 			, "^g":		self.open_last_link
 			, "^r":		self.reload_client
+			, "^x":		OPENER.cancel
 		})
 
 		linkopen.open_link.add_redraw_method(self.redo_lines)
+		VISITED.add_redraw_method(self.redo_lines)
 
 	def _callback(self, text): #pylint: disable=method-hidden
 		'''Open selected message's links or send message'''
 		#if it's not just spaces
 		if not text.isspace():
-			linkopen.visit_link(linkopen.LINK_RE.findall(text))
+			links = linkopen.LINK_RE.findall(text)
+			linkopen.visit_link(links)
+			VISITED.visit(links)
 			self.bot.send_post(text)
 
 	def _max_select(self):
@@ -774,10 +2654,11 @@ class ChatangoOverlay(client.ChatOverlay):
 	def clear(self):
 		super().clear()
 		self.last_links.clear()
+		self.image_links.clear()
 
 	def _show_links(self):
 		'''List accumulated links'''
-		LinkOverlay(self.parent, self.last_links).add()
+		LinkOverlay(self.parent, self.last_links, self.image_links).add()
 
 	def _show_members(self):
 		'''List members of current group'''
@@ -790,9 +2671,7 @@ class ChatangoOverlay(client.ChatOverlay):
 		@box.key_handler("enter")
 		def select(me): #pylint: disable=unused-variable
 			'''Reply to user'''
-			current = me.selected.name
-			if current[0] in "!#":
-				current = current[1:]
+			current = UserKey.of(me.selected.name).bare
 			#reply
 			self.text.append("@%s " % current)
 			return -1
@@ -800,20 +2679,21 @@ class ChatangoOverlay(client.ChatOverlay):
 		@box.key_handler("tab")
 		def tab(me): #pylint: disable=unused-variable
 			'''Ignore/unignore user'''
-			current = users[me.it].name.lower()
+			current = UserKey.of(users[me.it].name).key
 			self.bot.ignores.symmetric_difference_update((current,))
+			self.bot.filters.invalidate()
 			self.redo_lines()
 
 		@box.key_handler("a")
 		def get_avatar(me): #pylint: disable=unused-variable
 			'''Get avatar'''
 			current = users[me.it]
-			linkopen.open_link(self.parent, current.avatar)
+			open_link(self.parent, current.avatar)
 
 		@box.line_drawer
 		def draw_ignored(_, string, i): #pylint: disable=unused-variable
 			string.setstr(format(users[i]))
-			selected = users[i].name.lower()
+			selected = UserKey.of(users[i].name).key
 			if selected in self.bot.ignores:
 				string.add_indicator('i', BEGIN_COLORS+3)
 
@@ -839,6 +2719,7 @@ class ChatangoOverlay(client.ChatOverlay):
 			'''Ignore/unignore channel'''
 			self.bot.filtered_channels[me.it] = \
 				not self.bot.filtered_channels[me.it]
+			self.bot.filters.invalidate()
 			self.redo_lines()
 
 		@box.line_drawer
@@ -854,10 +2735,36 @@ class ChatangoOverlay(client.ChatOverlay):
 		'''Options'''
 		Options.add(self.parent, self)
 
+	def _show_conversations(self):
+		'''List private conversations'''
+		if self.bot.privates is None:
+			self.parent.loop.create_task(self.bot.connect_pm())
+		#most recent first
+		conversations = list(reversed(self.bot.conversations.values()))
+		if not conversations:
+			self.parent.blurb.push("No PMs; start a conversation with /pm")
+			return
+		box = client.ListOverlay(self.parent
+			, [i.user.name for i in conversations])
+
+		@box.key_handler("enter")
+		def select(me): #pylint: disable=unused-variable
+			'''Open conversation'''
+			PMOverlay(self.parent, self.bot, conversations[me.it]).add()
+			return -1
+
+		@box.line_drawer
+		def draw_unread(_, string, i): #pylint: disable=unused-variable
+			if conversations[i].unread:
+				string.add_indicator(str(min(conversations[i].unread, 9))
+					, BEGIN_COLORS+3)
+
+		box.add()
+
 	def _replies_scroller(self):
 		'''List replies in message scroller'''
 		callback = lambda message: isinstance(message, ChatangoMessage) \
-			and message.reply
+			and message.update_reply()
 		client.add_message_scroller(self, callback
 			, empty="No replies have been accumulated"
 			, early="Earliest reply selected"
@@ -887,16 +2794,23 @@ class ChatangoOverlay(client.ChatOverlay):
 		Add links to last_links. Prepend argument for adding links backwards,
 		like with historical messages.
 		'''
-		links = []
-		#don't add the same link twice
-		for i in linkopen.LINK_RE.findall(raw+' '):
-			if i not in links:
-				links.append(i)
+		self.add_links(unique_links(raw), prepend)
+
+	def add_links(self, links, prepend=False):
+		'''
+		Add list of links to last_links. If `prepend`, the list is reversed
+		and added to the beginning, as parse_links does.
+		'''
+		images = [i for i in links if is_image(i)]
+		#modify in place, so that open LinkOverlays stay current
 		if prepend:
 			links.reverse()
-			self.last_links = links + self.last_links
+			images.reverse()
+			self.last_links[:0] = links
+			self.image_links[:0] = images
 		else:
 			self.last_links.extend(links)
+			self.image_links.extend(images)
 
 	def open_last_link(self):
 		'''Open last link'''
@@ -904,7 +2818,7 @@ class ChatangoOverlay(client.ChatOverlay):
 		if not links:
 			return
 		last = links[-1]
-		linkopen.open_link(self.parent, last)
+		open_link(self.parent, last)
 		self.redo_lines()
 
 	#PARENT BOT RELATED--------------------------------------------------------
@@ -937,6 +2851,39 @@ class ChatangoOverlay(client.ChatOverlay):
 
 		self.parent.loop.create_task(callback())
 
+class PMOverlay(client.ChatOverlay):
+	'''ChatOverlay showing a single private conversation'''
+	def __init__(self, parent, bot, conversation):
+		super().__init__(parent)
+		self.bot = bot
+		self.conversation = conversation
+		self.left = "PM with {}".format(conversation.user.name)
+		conversation.show_latest()
+		for post in conversation.page():
+			self.msg_append(PrivateMessage(post, True))
+
+	def add(self):
+		self.bot.pm_view = self
+		self.conversation.unread = 0
+		self.bot.update_status()
+		super().add()
+
+	def remove(self):
+		if self.bot.pm_view is self:
+			self.bot.pm_view = None
+		super().remove()
+
+	def _callback(self, text): #pylint: disable=method-hidden
+		'''Send private message'''
+		if not text.isspace():
+			self.bot.send_pm(self.conversation.user.bare, text)
+
+	def _max_select(self):
+		#load the next page of the conversation
+		for post in reversed(self.conversation.page()):
+			self.msg_prepend(PrivateMessage(post, True))
+		super()._max_select()
+
 #COMMANDS-------------------------------------------------------------------
 @client.command("ignore")
 def _(parent, person, *args): #pylint: disable=unused-argument
@@ -947,9 +2894,11 @@ def _(parent, person, *args): #pylint: disable=unused-argument
 
 	if person[0] == '@':
 		person = person[1:]
+	person = UserKey.of(person).key
 	if person in chatbot.ignores:
 		return
 	chatbot.ignores.add(person)
+	chatbot.filters.invalidate()
 	chatbot.overlay.redo_lines()
 
 @client.command("unignore")
@@ -963,12 +2912,151 @@ def _(parent, person, *args): #pylint: disable=unused-argument
 		person = person[1:]
 	if person in ("all", "everyone"):
 		chatbot.ignores.clear()
+		chatbot.filters.invalidate()
 		chatbot.overlay.redo_lines()
 		return
+	person = UserKey.of(person).key
 	if person not in chatbot.ignores:
 		return
 	chatbot.ignores.remove(person)
-	chatbot.main_overlay.redo_lines()
+	chatbot.filters.invalidate()
+	chatbot.overlay.redo_lines()
+
+def _parse_rule(args):
+	'''Parse command arguments `kind pattern [channel]` into a rule'''
+	kind, pattern, *channel = args
+	if not channel:
+		return kind, pattern, None
+	try:
+		number = int(channel[0])
+	except ValueError:
+		lower_names = [i.lower() for i in pytango.CHANNEL_NAMES]
+		try:
+			return kind, pattern, lower_names.index(channel[0].lower())
+		except ValueError:
+			raise ValueError("Unknown channel '{}'".format(channel[0])) from None
+	if not 0 <= number < len(pytango.CHANNEL_NAMES):
+		raise ValueError("Channel must be between 0 and {}".format(
+			len(pytango.CHANNEL_NAMES) - 1))
+	return kind, pattern, number
+
+@client.command("filter")
+def _(parent, *args):
+	'''Add filter rule: kind (user/glob/regex/domain/class) pattern [channel]'''
+	chatbot = get_client()
+	if not chatbot:
+		return
+	if len(args) < 2:
+		parent.blurb.push("Usage: /filter kind pattern [channel]")
+		return
+
+	try:
+		chatbot.filters.add(*_parse_rule(args))
+	except ValueError as exc:
+		parent.blurb.push(str(exc))
+		return
+	chatbot.overlay.redo_lines()
+
+@client.command("unfilter")
+def _(parent, *args):
+	'''Remove filter rule: kind pattern [channel]'''
+	chatbot = get_client()
+	if not chatbot:
+		return
+	if len(args) < 2:
+		parent.blurb.push("Usage: /unfilter kind pattern [channel]")
+		return
+
+	try:
+		removed = chatbot.filters.remove(*_parse_rule(args))
+	except ValueError as exc:
+		parent.blurb.push(str(exc))
+		return
+	if removed:
+		chatbot.overlay.redo_lines()
+
+@client.command("filters")
+def _(parent, *args): #pylint: disable=unused-argument
+	'''List filter rules'''
+	chatbot = get_client()
+	if not chatbot:
+		return None
+	rules = chatbot.filters.rules
+	if not rules:
+		parent.blurb.push("No filter rules; add some with /filter")
+		return None
+	box = client.ListOverlay(parent, [" ".join((kind, pattern
+		, "all" if channel is None else pytango.CHANNEL_NAMES[channel])) \
+		for kind, pattern, channel in rules])
+
+	@box.key_handler("tab")
+	def remove(me): #pylint: disable=unused-variable
+		'''Remove filter rule'''
+		chatbot.filters.remove(*rules[me.it])
+		chatbot.overlay.redo_lines()
+		return -1
+
+	return box
+
+@client.command("highlight")
+def _(parent, *args):
+	'''Add highlight keywords, which are treated like replies'''
+	chatbot = get_client()
+	if not chatbot:
+		return None
+	if args:
+		chatbot.highlights.add(*args)
+		chatbot.overlay.redo_lines()
+		return None
+	if not chatbot.highlights:
+		parent.blurb.push("No highlight keywords; add some with /highlight")
+		return None
+	return client.ListOverlay(parent, chatbot.highlights.keywords)
+
+@client.command("unhighlight")
+def _(parent, *args): #pylint: disable=unused-argument
+	'''Remove highlight keywords'''
+	chatbot = get_client()
+	if not chatbot:
+		return
+	chatbot.highlights.remove(*args)
+	chatbot.overlay.redo_lines()
+
+@client.command("pm")
+def _(parent, person, *args):
+	'''Open a private conversation with person, optionally sending a message'''
+	chatbot = get_client()
+	if not chatbot:
+		return None
+
+	if person[0] == '@':
+		person = person[1:]
+	conversation = chatbot.conversation(UserKey.of(person))
+
+	async def send():
+		await chatbot.connect_pm()
+		if args:
+			chatbot.send_pm(conversation.user.bare, ' '.join(args))
+	chatbot.loop.create_task(send())
+	return PMOverlay(parent, chatbot, conversation)
+
+@client.command("stats")
+def _(parent, *args): #pylint: disable=unused-argument
+	'''Show activity statistics for the current room'''
+	chatbot = get_client()
+	if not chatbot:
+		return None
+	return client.ListOverlay(parent, chatbot.stats.lines())
+
+@client.command("clearqueue")
+def _(parent, *args): #pylint: disable=unused-argument
+	'''Drop posts waiting to be sent, i.e. during a flood ban'''
+	chatbot = get_client()
+	if not chatbot:
+		return
+	dropped = len(chatbot.post_queue)
+	chatbot.post_queue.clear()
+	parent.blurb.push("Dropped {} queued posts".format(dropped))
 
 @client.command("keys")
 def _(parent, *args): #pylint: disable=unused-argument
@@ -980,24 +3068,58 @@ def _(parent, *args): #pylint: disable=unused-argument
 
 	return chatbot.overlay.open_help()
 
+@client.command("debug")
+def _(parent, *args): #pylint: disable=unused-argument
+	'''Show instrumentation counters'''
+	return client.ListOverlay(parent, [i() for i in _INSTRUMENTS])
+
+def _file_location(args):
+	location = path.expanduser(' '.join(args))
+	location = location.replace("\\ ", ' ')
+
+	if not location.find("file://"):
+		location = location[7:]
+	return location
+
 @client.command("avatar", client.tab_file)
-def _(parent, *args):
+def _(parent, *args): #pylint: disable=unused-argument
 	'''Upload file as user avatar'''
 	chatbot = get_client()
 	if not chatbot:
 		return
 
-	location = path.expanduser(' '.join(args))
-	location = location.replace("\\ ", ' ')
+	location = _file_location(args)
+	chatbot.loop.create_task(chatbot.upload_avatar_async(location))
 
-	if not location.find("file://"):
-		location = location[7:]
+@client.command("export", client.tab_file)
+def _(parent, *args): #pylint: disable=unused-argument
+	'''
+	Export shown messages to a transcript file: JSON lines (.jsonl) or columns
+	(.json), gzipped if it ends in .gz. Defaults to .jsonl.gz.
+	With -r room, export the snapshot of that room instead.
+	'''
+	chatbot = get_client()
+	if not chatbot or not args:
+		return
 
-	success = chatbot.upload_avatar(location)
-	if success:
-		parent.blurb.push("Successfully updated avatar")
-	else:
-		parent.blurb.push("Failed to update avatar")
+	room = None
+	if args[0] == "-r" and len(args) > 2:
+		room, args = args[1], args[2:]
+	location = _file_location(args)
+	if not location.endswith(TRANSCRIPT_EXTENSIONS):
+		location += ".jsonl.gz"
+
+	chatbot.loop.create_task(chatbot.export_transcript(location, room))
+
+@client.command("import", client.tab_file)
+def _(parent, *args): #pylint: disable=unused-argument
+	'''Show messages from a transcript file made by /export'''
+	chatbot = get_client()
+	if not chatbot or not args:
+		return
+
+	chatbot.loop.create_task(chatbot.import_transcript(
+		_file_location(args)))
 
 async def start_client(manager, creds):
 	#fill in credential holes
@@ -1020,17 +3142,19 @@ async def start_client(manager, creds):
 		creds.set_write("ignores")
 
 	linkopen.open_link.warning_count = creds["options"]["linkwarn"]
+	OPENER.workers = creds["options"]["openlimit"]
+	HISTORY_PREPARER.workers = creds["options"]["historyworkers"]
 	client.colors.two56on = creds["options"]["256color"]
 	manager.screen.mouse = creds["options"]["mouse"]
 
+	snapshot = await in_executor(read_snapshot, creds["room"])
+
 	global _CLIENT #pylint: disable=global-statement
-	_CLIENT = ChatBot(manager.screen, creds)
+	_CLIENT = ChatBot(manager.screen, creds, snapshot)
 
 def main():
 	#parse arguments and start client
 	import argparse
-	import os
-	import sys
 
 	if not path.exists(HOME_PATH):
 		os.mkdir(HOME_PATH)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#colorcheck.py
+'''
+Check ChatangoMessage.colorize against the colorize it replaced, then time
+both. Posts come from transcripts made by /export, or are generated with the
+traffic generator in loadtest.py if none are given. The two are compared by
+the colors they insert (with later insertions at a position replacing earlier
+ones, and redundant runs dropped) and by the effects they add.
+'''
+import argparse
+import random
+import time
+
+import term_cancer as client
+from term_cancer import linkopen
+import chatango
+import loadtest
+
+class Recorder:
+	'''Mixin recording the colors and effects that colorize adds'''
+	def start_recording(self):
+		self.recorded = ([], [], [])
+
+	def insert_color(self, position, color):
+		if hasattr(self, "recorded"):
+			self.recorded[0].append((position, color))
+		return super().insert_color(position, color)
+
+	def effect_range(self, start, end, effect):
+		if hasattr(self, "recorded"):
+			self.recorded[1].append((start, end, effect))
+		return super().effect_range(start, end, effect)
+
+	def add_global_effect(self, effect, pos=0):
+		if hasattr(self, "recorded"):
+			self.recorded[2].append((effect, pos))
+		return super().add_global_effect(effect, pos)
+
+	def coloring(self):
+		'''The recorded colors as runs, and the recorded effects'''
+		colors, effects, global_effects = self.recorded
+		by_position = {}
+		for position, color in colors:
+			by_position[position] = color
+		runs, last = [], None
+		for position in sorted(by_position):
+			if by_position[position] != last:
+				runs.append((position, by_position[position]))
+				last = by_position[position]
+		return runs, sorted(effects), sorted(global_effects)
+
+class LegacyMessage(chatango.ChatangoMessage):
+	'''ChatangoMessage with the colorize from before posts were tokenized'''
+	def colorize(self):
+		raw_white = client.colors.raw_num(0)
+		#these names are important
+		name_color = client.two56(self.post.n_color)
+		font_color = client.two56(self.post.f_color)
+		visited_link = client.grayscale(12)
+
+		#use name colors?
+		username = str(self.post.user)
+		if not self.bot.options["htmlcolor"] \
+		or (self.bot.options["anoncolor"] and username[0] in "!#"):
+			name_color = chatango.get_color(username)
+			font_color = chatango.get_color(username)
+
+		#greentext, font color
+		text_color = lambda x: x[0] == '>' and chatango.BEGIN_COLORS+11 \
+			or font_color
+		self.color_by_regex(self._LINE_RE, text_color, group=3)
+
+		#links in white; visited links now come from chatango.VISITED
+		link_color = lambda x: visited_link \
+			if chatango.VISITED.is_visited(x) else raw_white
+		self.color_by_regex(linkopen.LINK_RE, link_color, font_color, 1)
+
+		#underline quotes
+		self.effect_by_regex(self._QUOTE_RE, 1)
+
+		#make sure we color the name right
+		self.insert_color(1, name_color)
+		#insurance the @s before a > are colored right
+		#		space/username/:(space)
+		msg_start = 1+len(username)+2
+		if not self.colored_at(msg_start):
+			self.insert_color(msg_start, font_color)
+		if self.reply:
+			self.add_global_effect(0, 1)
+		if self.history:
+			self.add_global_effect(1, 1)
+
+		#channel
+		self.insert_color(0, chatango.BEGIN_COLORS + self.post.channel + 12)
+
+#only checked messages record; timed ones are left as they are
+class RecordingMessage(Recorder, chatango.ChatangoMessage):
+	'''The current ChatangoMessage, recording'''
+
+class RecordingLegacyMessage(Recorder, LegacyMessage):
+	'''LegacyMessage, recording'''
+
+class FakeBot:
+	'''Just enough of a ChatBot to make messages'''
+	def __init__(self):
+		creds = chatango.make_creds()
+		self.options = creds["options"]
+		self.options["bell"] = False
+		self.filters = chatango.FilterRules(set(), [0, 0, 0, 0], [])
+		self.highlights = chatango.KeywordMatcher([])
+
+def generate_posts(count, seed):
+	'''Generated posts, with some greentext, quotes, replies, and newlines'''
+	args = argparse.Namespace(seed=seed, length=80, links=0.5, rtl=0.05)
+	group = loadtest.FakeGroup("colorcheck", "colorcheck", 50)
+	generator = loadtest.TrafficGenerator(None, group, args)
+	rand = random.Random(seed)
+	posts = []
+	for i in range(count):
+		post = generator.make_post(i)
+		extra = rand.random()
+		if extra < 0.1:
+			post.post = ">" + post.post
+		elif extra < 0.2:
+			post.post = "@user1: `{}` {}".format(post.post[:20], post.post)
+		elif extra < 0.3:
+			post.post = post.post.replace(" ", "\n>", 1)
+		elif extra < 0.4:
+			post.post = "@me " + post.post
+			post.mentions = ["me"]
+		if rand.random() < 0.2:
+			post.user = rand.choice(("!anon1234", "#temp"))
+		posts.append(post)
+	return posts
+
+def make_messages(cls, bot, posts):
+	return [cls(post, bot, "me", i % 2 == 0) for i, post in enumerate(posts)]
+
+def check(bot, posts, show=5):
+	'''Compare both colorizes on each post. Returns the number of mismatches.'''
+	mismatches = 0
+	for new, old in zip(make_messages(RecordingMessage, bot, posts)
+	, make_messages(RecordingLegacyMessage, bot, posts)):
+		for message in (new, old):
+			message.start_recording()
+			message.colorize()
+		if new.coloring() != old.coloring():
+			mismatches += 1
+			if mismatches <= show:
+				print("Mismatch: {!r}\n  new {}\n  old {}".format(str(new)
+					, new.coloring(), old.coloring()))
+	return mismatches
+
+def benchmark(bot, posts, repeat):
+	'''
+	Best times over `repeat` runs to colorize fresh messages of `posts`, and to
+	colorize them again (as redo_lines does), for the old and new colorize
+	'''
+	ret = []
+	for cls in (LegacyMessage, chatango.ChatangoMessage):
+		first, again = None, None
+		for _ in range(repeat):
+			messages = make_messages(cls, bot, posts)
+			times = []
+			for _ in range(2):
+				start = time.perf_counter()
+				for message in messages:
+					message.colorize()
+				times.append(time.perf_counter() - start)
+			first = times[0] if first is None else min(first, times[0])
+			again = times[1] if again is None else min(again, times[1])
+		ret.append((first, again))
+	return ret
+
+def main():
+	parser = argparse.ArgumentParser(description="Check the current colorize "\
+		"against the old one, and time both")
+	parser.add_argument("transcripts", nargs='*'
+		, help="transcripts made by /export to use as posts")
+	parser.add_argument("--count", type=int, default=5000
+		, help="posts to generate without transcripts (default: 5000)")
+	parser.add_argument("--repeat", type=int, default=5
+		, help="benchmark runs, of which the best is kept (default: 5)")
+	parser.add_argument("--seed", type=int, default=0
+		, help="random seed for generated posts (default: 0)")
+	args = parser.parse_args()
+
+	chatango.create_colors()
+	if args.transcripts:
+		posts = [post for i in args.transcripts \
+			for post in chatango.read_transcript(i)]
+	else:
+		posts = generate_posts(args.count, args.seed)
+	bot = FakeBot()
+
+	mismatches = check(bot, posts)
+	print("{} of {} posts colored differently".format(mismatches, len(posts)))
+	old, new = benchmark(bot, posts, args.repeat)
+	for name, (first, again) in (("Old", old), ("New", new)):
+		print("{} colorize: {:.2f} us/post, again {:.2f} us/post".format(name
+			, 1e6*first/len(posts), 1e6*again/len(posts)))
+	print("Speedup: {:.2f}x, again {:.2f}x".format(old[0]/new[0]
+		, old[1]/new[1]))
+	return 1 if mismatches else 0
+
+if __name__ == "__main__":
+	raise SystemExit(main())
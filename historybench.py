@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#historybench.py
+'''
+Time preparing a large history batch, the way ChatBot.on_history_done does for
+older history: the posts are prepared by HistoryPreparer on a pool of worker
+processes, then made into messages and colorized. The same is timed without
+workers, when everything is done on the event loop. Posts come from transcripts
+made by /export, or are generated with the traffic generator in loadtest.py if
+none are given.
+'''
+import argparse
+import asyncio
+import os
+import time
+
+import chatango
+import colorcheck
+
+def show(bot, posts, prepared):
+	'''Make messages and colorize them, as the overlay would'''
+	for post, ready in zip(posts, prepared):
+		message = chatango.ChatangoMessage(post, bot, "me", True, prepared=ready)
+		if ready is None:
+			chatango.unique_links(post.post)
+		message.filter()
+		message.colorize()
+
+async def run(bot, posts, workers, repeat):
+	'''Best wall-clock time over `repeat` runs to show `posts` with `workers`'''
+	preparer = chatango.HistoryPreparer(workers)
+	preparer.threshold = 0
+	best = None
+	try:
+		if workers:
+			#don't count starting the pool
+			await preparer.prepare(posts[:workers], bot.filters, bot.highlights)
+		for _ in range(repeat):
+			start = time.perf_counter()
+			prepared = await preparer.prepare(posts, bot.filters, bot.highlights)
+			if workers and prepared is None:
+				raise RuntimeError("Process pool failed")
+			show(bot, posts, prepared or [None] * len(posts))
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+	finally:
+		preparer.shutdown()
+	return best
+
+def main():
+	parser = argparse.ArgumentParser(description="Time preparing a history "\
+		"batch on worker processes against preparing it in-process")
+	parser.add_argument("transcripts", nargs='*'
+		, help="transcripts made by /export to use as posts")
+	parser.add_argument("--count", type=int, default=10000
+		, help="posts to generate without transcripts (default: 10000)")
+	parser.add_argument("--workers", type=int, nargs='+'
+		, default=sorted({1, 2, 4, os.cpu_count() or 1})
+		, help="worker counts to time (default: 1 2 4 and the CPU count)")
+	parser.add_argument("--repeat", type=int, default=3
+		, help="runs of each, of which the best is kept (default: 3)")
+	parser.add_argument("--seed", type=int, default=0
+		, help="random seed for generated posts (default: 0)")
+	args = parser.parse_args()
+
+	chatango.create_colors()
+	if args.transcripts:
+		posts = [post for i in args.transcripts \
+			for post in chatango.read_transcript(i)]
+	else:
+		posts = colorcheck.generate_posts(args.count, args.seed)
+	bot = colorcheck.FakeBot()
+	#make the filters do some work
+	bot.filters = chatango.FilterRules(set(), [0, 0, 0, 0]
+		, [["regex", r"\bwhy\b", None], ["domain", "example.org", None]])
+
+	loop = asyncio.new_event_loop()
+	try:
+		baseline = loop.run_until_complete(run(bot, posts, 0, args.repeat))
+		print("{} posts on {} CPUs".format(len(posts), os.cpu_count()))
+		print("In-process: {:.1f} ms".format(1000*baseline))
+		for workers in args.workers:
+			elapsed = loop.run_until_complete(run(bot, posts, workers
+				, args.repeat))
+			print("{} workers: {:.1f} ms, {:.2f}x".format(workers
+				, 1000*elapsed, baseline/elapsed))
+	finally:
+		loop.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#loadtest.py
+'''
+Synthetic room traffic for load testing the client. Runs a `ChatBot` against a
+fake group instead of a chatango connection, generating posts, links, RTL text,
+and member churn at a configurable rate, then prints how far the client fell
+behind: the lag from a post's timestamp until it has been handled and drawn,
+and the latency of the event loop itself.
+'''
+import argparse
+import asyncio
+import random
+import time
+
+import term_cancer as client
+import chatango
+
+WORDS = ("the", "a", "client", "room", "post", "what", "lol", "yes", "no"
+	, "anyway", "chatango", "terminal", "message", "link", "image", "ok"
+	, "why", "because", "tomorrow", ">implying", "@anon")
+FIRST_HISTORY = 50	#posts of history sent on joining, before the timed batch
+
+def percentiles(samples, points=(50, 90, 99)):
+	'''Get the given percentiles and the maximum of a list of samples'''
+	if not samples:
+		return []
+	samples = sorted(samples)
+	ret = [("p{}".format(i), samples[min(len(samples) - 1, len(samples)*i // 100)]) \
+		for i in points]
+	ret.append(("max", samples[-1]))
+	return ret
+
+class FakeUser:
+	'''Stand-in for a pytango User'''
+	def __init__(self, name):
+		self.name = name
+		self.avatar = "https://example.com/avatars/{}.jpg".format(name)
+
+	def __str__(self):
+		return self.name
+
+	def __format__(self, spec):
+		return format(self.name, spec)
+
+class FakeGroup:
+	'''Stand-in for a pytango group, which counts posts instead of sending them'''
+	def __init__(self, name, username, members):
+		self.name = name
+		self.username = username
+		self.users = [FakeUser("user{}".format(i)) for i in range(members)]
+		self.last_message = time.time()
+		self.no_more = True
+		self.sent = 0
+		self.f_color = self.n_color = self.f_face = self.f_size = None
+
+	@property
+	def usercount(self):
+		return len(self.users)
+
+	def send_post(self, text, channel): #pylint: disable=unused-argument
+		self.sent += 1
+
+	def get_more(self):
+		pass
+
+class TrafficGenerator:
+	'''Generates posts and member churn for a FakeGroup and measures lag'''
+	def __init__(self, bot, group, args):
+		self.bot = bot
+		self.group = group
+		self.args = args
+		self.lags = []
+		self.loop_latency = []
+		self.history_time = None
+		self.posts = 0
+		self._random = random.Random(args.seed)
+		self._colors = {}	#user name: name color, like a real room
+
+	def make_post(self, when):
+		'''Make a post at time `when`'''
+		rand = self._random
+		args = self.args
+		words = []
+		length = 0
+		while length < args.length:
+			if rand.random() < args.links / 8:
+				word = "https://example.com/{}.{}".format(rand.randrange(10**6)
+					, rand.choice(("png", "jpg", "html")))
+			else:
+				word = rand.choice(WORDS)
+			words.append(word)
+			length += len(word) + 1
+		text = ' '.join(words)
+		if rand.random() < args.rtl:
+			#right-to-left override in the middle of the post
+			middle = len(text) // 2
+			text = text[:middle] + "\u202e" + text[middle:] + "\u202c"
+		user = rand.choice(self.group.users).name
+		if user not in self._colors:
+			self._colors[user] = "{:06x}".format(rand.randrange(1 << 24))
+		return chatango.SnapshotPost(user, text, when, rand.randrange(4)
+			, self._colors[user], "000000", [])
+
+	async def monitor_loop(self, interval=0.01):
+		'''Measure how late the event loop wakes up from sleeps'''
+		while True:
+			start = time.perf_counter()
+			await asyncio.sleep(interval)
+			self.loop_latency.append(time.perf_counter() - start - interval)
+
+	def _drawn(self, posted):
+		#scheduled after the message is handled, so this runs after the redraw
+		self.lags.append(time.time() - posted)
+
+	async def churn(self):
+		'''Have members join and leave'''
+		if not self.args.churn:
+			return
+		number = len(self.group.users)
+		while True:
+			await asyncio.sleep(self._random.expovariate(self.args.churn))
+			if self._random.random() < 0.5 and self.group.users:
+				user = self.group.users.pop(self._random.randrange(
+					len(self.group.users)))
+				await self.bot.on_member_leave(self.group, user.name)
+			else:
+				user = FakeUser("user{}".format(number))
+				number += 1
+				self.group.users.append(user)
+				await self.bot.on_member_join(self.group, user.name)
+			await self.bot.on_usercount(self.group)
+
+	async def run(self):
+		'''Send history, then generate traffic for the requested duration'''
+		loop = asyncio.get_event_loop()
+		args = self.args
+		now = time.time()
+		if args.history:
+			#newest first, like pytango. The first batch is what joining gets;
+			#the timed one is older history, like from get_more
+			history = [self.make_post(now - i) \
+				for i in range(FIRST_HISTORY + args.history)]
+			await self.bot.on_history_done(self.group, history[:FIRST_HISTORY])
+			start = time.perf_counter()
+			await self.bot.on_history_done(self.group, history[FIRST_HISTORY:])
+			self.history_time = time.perf_counter() - start
+
+		tasks = [loop.create_task(self.monitor_loop())
+			, loop.create_task(self.churn())]
+		start = time.time()
+		next_post = start
+		while next_post - start < args.duration:
+			next_post += self._random.expovariate(args.rate)
+			delay = next_post - time.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			await self.bot.on_message(self.group, self.make_post(next_post))
+			loop.call_soon(self._drawn, next_post)
+			self.posts += 1
+
+		for task in tasks:
+			task.cancel()
+		self.bot.quit_client()
+
+	def report(self):
+		'''Print measurements'''
+		args = self.args
+		print("{} posts at {}/s target for {}s ({} members, {} chars, "\
+			"{:.0%} links, {:.0%} RTL, {}/s churn)".format(self.posts, args.rate
+			, args.duration, args.members, args.length, args.links, args.rtl
+			, args.churn))
+		if self.history_time is not None:
+			print("Older history of {} posts handled in {:.1f} ms ({} workers)"\
+				.format(args.history, 1000*self.history_time, args.workers))
+		print("Post to render lag: " + ", ".join("{} {:.1f} ms".format(
+			i, 1000*j) for i, j in percentiles(self.lags)))
+		print("Event loop latency: " + ", ".join("{} {:.1f} ms".format(
+			i, 1000*j) for i, j in percentiles(self.loop_latency)))
+
+class LoadBot(chatango.ChatBot):
+	'''ChatBot connected to a FakeGroup driven by a TrafficGenerator'''
+	generator = None
+	def __init__(self, parent, creds, args, quit_client):
+		self.args = args
+		self.quit_client = quit_client
+		super().__init__(parent, creds)
+
+	async def join_group(self, group_name, keep_history=False):
+		group = FakeGroup(group_name, self.creds["user"], self.args.members)
+		self.joined_group = group
+		await self.on_connect(group)
+		await self.on_participants(group)
+		await self.on_usercount(group)
+		LoadBot.generator = TrafficGenerator(self, group, self.args)
+		self.loop.create_task(self.generator.run())
+
+	async def leave_group(self, group):
+		pass
+
+	async def leave_all(self):
+		pass
+
+	async def graceful_exit(self):
+		#don't leave snapshots or visited links of fake rooms behind
+		pass
+
+def main():
+	parser = argparse.ArgumentParser(description="Drive the client with "\
+		"synthetic room traffic and report how far behind it falls")
+	parser.add_argument("--rate", type=float, default=20
+		, help="posts per second (default: 20)")
+	parser.add_argument("--duration", type=float, default=30
+		, help="seconds of traffic (default: 30)")
+	parser.add_argument("--length", type=int, default=80
+		, help="approximate characters per post (default: 80)")
+	parser.add_argument("--links", type=float, default=0.2
+		, help="average links per post (default: 0.2)")
+	parser.add_argument("--rtl", type=float, default=0.05
+		, help="fraction of posts with RTL text (default: 0.05)")
+	parser.add_argument("--members", type=int, default=100
+		, help="members in the room (default: 100)")
+	parser.add_argument("--churn", type=float, default=0.5
+		, help="joins and leaves per second (default: 0.5)")
+	parser.add_argument("--history", type=int, default=0
+		, help="posts of older history to load first, as when scrolling up "\
+		"(default: 0)")
+	parser.add_argument("--workers", type=int, default=0
+		, help="processes for preparing history (default: 0)")
+	parser.add_argument("--seed", type=int, default=None
+		, help="random seed")
+	args = parser.parse_args()
+
+	#not read from or written to disk
+	creds = chatango.make_creds()
+	creds["user"], creds["passwd"], creds["room"] = "loadtest", "", "loadtest"
+
+	async def start(manager, creds):
+		chatango.HISTORY_PREPARER.workers = args.workers
+		client.colors.two56on = creds["options"]["256color"]
+		chatango._CLIENT = LoadBot(manager.screen, creds, args #pylint: disable=protected-access
+			, manager.stop)
+
+	chatango.create_colors()
+	try:
+		client.Manager.start(start, creds)
+	finally:
+		chatango.HISTORY_PREPARER.shutdown()
+	if LoadBot.generator is not None:
+		LoadBot.generator.report()
+
+if __name__ == "__main__":
+	main()